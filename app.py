@@ -1,19 +1,21 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
 from werkzeug.middleware.proxy_fix import ProxyFix
 import os
-import requests as req
-import random
-import time
 import json
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 from config import Config
-from services import get_next_id_from_google_sheet, add_to_google_sheet, \
-        is_id_unused, send_email_notification, send_slack_notification, \
-        upload_to_google_drive, delete_from_google_drive, \
-        validate_form_data, validate_file, validate_total_file_size
+from services import reserve_id_in_google_sheet, write_submission_rows, \
+        release_reserved_id, count_rows, deliver_notification, start_outbox_dispatcher, \
+        upload_files_to_google_drive, rollback_receipts, \
+        validate_form_data, validate_file, validate_total_file_size, \
+        start_hcaptcha_verification, start_journal_replicator, FORMS
+from services import idempotency
+from services import ratelimit  # registers the sqlite:// rate limit storage
+from services.metrics import HTTP_REQUESTS, HTTP_REQUEST_SECONDS, CONTENT_TYPE, render_metrics
+from services.tracing import start_trace, end_trace, current_trace, log_trace, span
 from services.utils import log_execution_time
 from services.logger import setup_logger, logger, RequestIDFilter
 import uuid
@@ -35,17 +37,33 @@ CORS(app)
 #    }
 #})
 
+# Deliver queued Slack/email notifications in the background (including any left over
+# from before a restart)
+if Config.NOTIFICATION_OUTBOX:
+    start_outbox_dispatcher()
+
+# Replicate journaled submissions to Google Sheets in the background
+if Config.SUBMISSION_JOURNAL:
+    start_journal_replicator()
+
 # Add ProxyFix to properly handle X-Forwarded-For headers from Cloud Run
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1)
 
-MAX_RETRIES = 5
+# Max submissions per hour per IP, also applied by the ASGI app
+SUBMISSION_RATE_LIMIT = "10 per hour"
 
 # Only enable rate limiting in production
+# Counters live in RATELIMIT_STORAGE_URI so all workers (and instances, with Redis) share one
+# budget per client; if the storage is unreachable requests fall back to per-process limits
 if Config.FLASK_ENV != 'development':
     limiter = Limiter(
         app=app,
         key_func=get_remote_address,
-        default_limits=["200 per day", "50 per hour"]
+        default_limits=["200 per day", "50 per hour"],
+        storage_uri=Config.RATELIMIT_STORAGE_URI,
+        strategy=Config.RATELIMIT_STRATEGY,
+        swallow_errors=True,
+        in_memory_fallback_enabled=True
     )
 else:
     # Create a disabled limiter for development
@@ -60,12 +78,31 @@ else:
 @app.before_request
 def set_request_id():
     g.request_id = str(uuid.uuid4())
+    _, g.trace_token = start_trace(g.request_id)
     logger.info("Incoming request", extra={
         'method': request.method,
         'path': request.path,
         'remote_addr': request.remote_addr
     })
 
+@app.after_request
+def add_server_timing(response):
+    """Report where the request spent its time, in the response and as one log record"""
+    trace = current_trace()
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+        log_trace(trace, method=request.method, path=request.path, status=response.status_code)
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUESTS.inc(path=route, method=request.method, status=response.status_code)
+        HTTP_REQUEST_SECONDS.observe(trace.elapsed_ms() / 1000, path=route)
+    return response
+
+@app.teardown_request
+def finish_trace(error=None):
+    token = g.pop('trace_token', None)
+    if token is not None:
+        end_trace(token)
+
 @log_execution_time
 def validate_config():
     logger.info("validating config")
@@ -74,13 +111,13 @@ def validate_config():
         'CAPTCHA_SECRET',
         'DEV_OUTBOUND_EMAIL_ADDRESS' if Config.FLASK_ENV == "development" else 'OUTBOUND_EMAIL_ADDRESS',
         'EMAIL_PASSWORD',
-        'DEV_RECIPIENT_EMAIL' if Config.FLASK_ENV == "development" else 'RR_RECIPIENT_EMAIL',
-        'DEV_RECIPIENT_EMAIL' if Config.FLASK_ENV == "development" else 'PA_RECIPIENT_EMAIL',
-        'RR_SHEET_ID',
-        'PA_SHEET_ID',
-        'RR_WORKSHEET_NAME',
-        'PA_WORKSHEET_NAME'
     ]
+    for form in FORMS.values():
+        required += [
+            'DEV_RECIPIENT_EMAIL' if Config.FLASK_ENV == "development" else f'{form.env_prefix}_RECIPIENT_EMAIL',
+            f'{form.env_prefix}_SHEET_ID',
+            f'{form.env_prefix}_WORKSHEET_NAME'
+        ]
     
     missing = [var for var in required if not os.environ.get(var)]
     
@@ -89,25 +126,42 @@ def validate_config():
         logger.error(f"Missing required environment variables: {missing}")    
         raise EnvironmentError(f"Missing: {', '.join(missing)}")
 
-@log_execution_time
-def verify_hcaptcha(token):
-    """Verify hCAPTCHA token"""
-    logger.info("validating hcaptcha")
+def extract_form_data(endpoint, submissionReq):
+    """
+    Extract form data, validate files, and sanitize all inputs
+    Returns: [status, data/error_message, http_code]
+    """
+    # Extract form data
+    raw_data = {
+        'firstName': submissionReq.form.get('firstName'),
+        'lastName': submissionReq.form.get('lastName'),
+        'email': submissionReq.form.get('email'),
+        'comments': submissionReq.form.get('comments', ''),
+        'expenses': submissionReq.form.get('expenses')
+    }
+
+    # Parse expenses JSON
     try:
-        response = req.post(
-            'https://hcaptcha.com/siteverify',
-            data={
-                'secret': Config.HCAPTCHA_SECRET_KEY,
-                'response': token
-            },
-            timeout=5
-        )
-        result = response.json()
-        return result.get('success', False)
-    except Exception as e:
-        logger.error("Error Occurred", extra={'error verifying hCAPTCHA':str(e)}, exc_info=True)
-        # print(f"Error verifying hCAPTCHA: {e}")
-        return False
+        if raw_data['expenses']:
+            raw_data['expenses'] = json.loads(raw_data['expenses'])
+        else:
+            return [0, 'No expenses provided', 400]
+    except json.JSONDecodeError:
+        return [0, 'Invalid expenses data format', 400]
+
+    with span('validation'):
+        # Validate and sanitize form data
+        valid, error_or_data, sanitized_data = validate_form_data(endpoint, raw_data)
+        if not valid:
+            return [0, error_or_data, 400]
+
+        # Validate total file size
+        if submissionReq.files:
+            valid, error = validate_total_file_size(submissionReq.files)
+            if not valid:
+                return [0, error, 400]
+    
+    return [1, sanitized_data]
 
 @log_execution_time
 def validate_and_extract_input(endpoint, submissionReq):
@@ -117,50 +171,31 @@ def validate_and_extract_input(endpoint, submissionReq):
     """
     logger.info("validating input")
     try:
-        # Verify captcha first before doing anything else
         captcha_token = submissionReq.form.get('captchaToken')
         if not captcha_token:
             return [0, 'Captcha token missing', 400]
-        
-        if not verify_hcaptcha(captcha_token):
-            return [0, 'Captcha verification failed. Please try again.', 400]
 
-        # Extract form data
-        raw_data = {
-            'firstName': submissionReq.form.get('firstName'),
-            'lastName': submissionReq.form.get('lastName'),
-            'email': submissionReq.form.get('email'),
-            'comments': submissionReq.form.get('comments', ''),
-            'expenses': submissionReq.form.get('expenses')
-        }
-
-        # Parse expenses JSON
-        try:
-            if raw_data['expenses']:
-                raw_data['expenses'] = json.loads(raw_data['expenses'])
-            else:
-                return [0, 'No expenses provided', 400]
-        except json.JSONDecodeError:
-            return [0, 'Invalid expenses data format', 400]
+        # Verify captcha in the background while the form is parsed and validated locally.
+        # Its result is still checked first, so nothing is reported back to a failed captcha.
+        captcha_check = start_hcaptcha_verification(captcha_token)
+        extracted = extract_form_data(endpoint, submissionReq)
 
-        # Validate and sanitize form data
-        valid, error_or_data, sanitized_data = validate_form_data(endpoint, raw_data)
-        if not valid:
-            return [0, error_or_data, 400]
-        
-        # Validate total file size
-        if submissionReq.files:
-            valid, error = validate_total_file_size(submissionReq.files)
-            if not valid:
-                return [0, error, 400]
-        
-        return [1, sanitized_data]
+        if not captcha_check.result():
+            return [0, 'Captcha verification failed. Please try again.', 400]
+        return extracted
         
     except Exception as e:
         # print(f"Error processing submission: {e}")
         logger.error("Error Occurred", extra={'error processing submission':str(e)}, exc_info=True)
         return [0, 'Internal server error', 500]
     
+def send_notifications(endpoint, data, file_links):
+    """Deliver the notifications configured for the form, returns {'slack': ok, 'email': ok}"""
+    form = FORMS[endpoint]
+    # a notification the form doesn't use counts as delivered
+    return {kind: deliver_notification(kind, endpoint, data, file_links) if form.notifies(kind) else True
+            for kind in ('slack', 'email')}
+
 @log_execution_time
 def build_return_message(results, endpoint):
     logger.info("building return message")
@@ -173,201 +208,180 @@ def build_return_message(results, endpoint):
 @log_execution_time
 def core_submission(data, files, endpoint):
     """
-    Process a submission: generate ID, validate and upload files, write to sheet
-    Returns: [status, data/error, http_code] where status: 1=success, 0=error, -1=race condition
+    Process a submission: validate files, reserve an ID, upload files, write to sheet
+    Returns: [status, data/error, http_code] where status: 1=success, 0=error
     """
     logger.info("processing submission")
-    # Establish an ID for the submission
-    logger.info("attempting to get next id")
-    print("attempting to get next id")
-    data['id'] = get_next_id_from_google_sheet(endpoint) 
-    if data['id'] == 0:
-        # print(f"Error processing submission: could not access google sheet")
-        logger.error("failed to access spreadsheet, returned id == 0")
-        return [0, 'Server Error: failed to access spreadsheet', 500]
-    
-    # Validate and upload files to Google Drive
     results = {}
     results['files_uploaded'] = {'len': 0, 'list': [], 'fid_list': []}
-    uploaded_files = []
-    folder_id = Config.GOOGLE_DRIVE_FOLDER[endpoint]
+    folder_id = FORMS[endpoint].drive_folder_id
 
-    uploadFailed = False
+    # Validate files before reserving an ID, so a bad attachment doesn't void a row
+    validated_files = []
     upload_errors = []
-    
     for key in files:
         file_data = files[key]
         if file_data.filename:
-            # Validate file
             valid, error, safe_filename = validate_file(file_data, file_data.filename)
             if not valid:
                 upload_errors.append(error)
-                uploadFailed = True
                 continue
-            
-            # Upload with sanitized filename
-            link, fid = upload_to_google_drive(file_data, safe_filename, 
-                        request_id=data["id"], parent_folder_id=folder_id)
-            if link:
-                uploaded_files.append({'fid': fid, 'link': link})
-            else:
-                uploadFailed = True
-                upload_errors.append(f"Failed to upload {safe_filename}")
-
-    if uploadFailed:
-        # Delete files that were uploaded, then return error
-        for file in uploaded_files:
-            delete_from_google_drive(file['fid'])
-        error_msg = 'File upload failed: ' + '; '.join(upload_errors) if upload_errors else 'Server Error: failed to upload one or more files'
-        # print(f"Error processing submission: {error_msg}")
-        logger.error("Error Occurred", extra={'error processing submission':str(e)}, exc_info=True)
-        return [0, error_msg, 400]
+            validated_files.append((file_data, safe_filename))
+
+    if upload_errors:
+        logger.error("file validation failed", extra={'errors': upload_errors})
+        return [0, 'File upload failed: ' + '; '.join(upload_errors), 400]
+
+    # Reserve an ID along with one sheet row per expense/file, so no other
+    # submission can be handed the same ID
+    logger.info("attempting to reserve next id")
+    row_count = count_rows(data, len(validated_files))
+    with span('reserve_id'):
+        reservation = reserve_id_in_google_sheet(endpoint, row_count)
+    if not reservation:
+        logger.error("failed to reserve id in spreadsheet")
+        return [0, 'Server Error: failed to access spreadsheet', 500]
+    data['id'] = reservation['id']
+
+    # Anything that goes wrong from here on must give the reserved rows back, otherwise they
+    # stay PENDING in the sheet
+    uploaded_files = []
+    try:
+        # Upload files to Google Drive in parallel, keeping the original order so
+        # sheet rows still line up with expenses. Failed batches are rolled back.
+        uploaded_files, upload_errors = upload_files_to_google_drive(
+            validated_files, request_id=data["id"], parent_folder_id=folder_id, fresh_id=True)
+
+        if upload_errors:
+            # Give the reserved rows back, then return error
+            with span('rollback'):
+                release_reserved_id(endpoint, reservation)
+            logger.error("Error processing submission: file upload failed", extra={'errors': upload_errors})
+            return [0, 'Server Error: failed to upload one or more files', 500]
     
-    # Pack files and file ids into results struct
-    for file in uploaded_files:
-        results['files_uploaded']['list'].append(file['link'])
-        results['files_uploaded']['fid_list'].append(file['fid'])
-    results['files_uploaded']["len"] = len(results['files_uploaded']['list'])
-
-    # Check for race condition
-    unique_id = is_id_unused(endpoint, data["id"])
-    if unique_id > 0:  # No race condition, proceed
-        results['google_sheet'] = add_to_google_sheet(endpoint, data, results['files_uploaded']['list'])
-    elif unique_id == 0:  # Connection error
-        return [0, "Connection to Google Sheet failed", 500]
-    else:  # Race condition occurred
-        return [-1, results]
-
-    if not results['google_sheet']:
-        # ID was fine but writing to sheet failed - delete uploaded files
+        # Pack files and file ids into results struct
         for file in uploaded_files:
-            delete_from_google_drive(file['fid'])
-        # print(f"Error processing submission: failed to record entry in google sheet")
-        logger.error(f"Error processing submission: failed to record entry in google sheet")
-        return [0, 'Server Error: failed to record entry in google sheet', 500]
+            results['files_uploaded']['list'].append(file['link'])
+            results['files_uploaded']['fid_list'].append(file['fid'])
+        results['files_uploaded']["len"] = len(results['files_uploaded']['list'])
+
+        # Recorded in the local journal and replicated to the sheet in the background when
+        # SUBMISSION_JOURNAL is enabled, otherwise written to the sheet directly
+        results['google_sheet'] = write_submission_rows(endpoint, reservation, data, results['files_uploaded']['list'])
+        if not results['google_sheet']:
+            # ID was fine but writing to sheet failed - delete uploaded files
+            with span('rollback'):
+                rollback_receipts(uploaded_files)
+                release_reserved_id(endpoint, reservation)
+            # print(f"Error processing submission: failed to record entry in google sheet")
+            logger.error(f"Error processing submission: failed to record entry in google sheet")
+            return [0, 'Server Error: failed to record entry in google sheet', 500]
+    except Exception as e:
+        logger.error("Error Occurred", extra={'error processing submission after reserving id':str(e)}, exc_info=True)
+        with span('rollback'):
+            rollback_receipts(uploaded_files)
+            release_reserved_id(endpoint, reservation)
+        return [0, 'Internal Server Error', 500]
 
     return [1, results]
 
 @log_execution_time
-def submission_handler_with_retry(data, files, endpoint):
+def submission_handler(data, files, endpoint):
     """
-    Handle submissions with retry logic for race conditions
+    Run a submission, turning unexpected errors into a server error response
     Returns: [status, data/error, http_code]
     """
-    logger.info("submission handler retry outer loop")
-    race_condition = True
-    counter = 0
-    
-    while race_condition:
-        try:
-            submission_results = core_submission(data, files, endpoint)
-        except Exception as e:
-            # print(f"Error when writing to google sheet: {e}")
-            logger.error("Error Occurred", extra={'error when writing to google sheet':str(e)}, exc_info=True)
-            return [0, "Internal Server Error", 500]
-            
-        if submission_results[0] > 0:
-            race_condition = False
-            results = submission_results[1]
-        elif submission_results[0] == 0:
-            return submission_results
-        else:  # Race condition occurred
-            counter += 1
-            results = submission_results[1]
-            # Clean up uploaded files
-            for file in results['files_uploaded']['fid_list']:
-                delete_from_google_drive(file['fid'])
-            
-            if counter < MAX_RETRIES:
-                wait_time = (2 ** counter) + random.random()
-                time.sleep(wait_time)
-            else:
-                # print(f"Error when accessing Google Sheet: max retries exceeded")
-                logger.error(f"Error when accessing Google Sheet: max retries exceeded")
-                return [0, "Internal Server Error", 500]
-                
-    return submission_results
+    logger.info("submission handler")
+    try:
+        return core_submission(data, files, endpoint)
+    except Exception as e:
+        # print(f"Error when writing to google sheet: {e}")
+        logger.error("Error Occurred", extra={'error when writing to google sheet':str(e)}, exc_info=True)
+        return [0, "Internal Server Error", 500]
 
 ########################### Endpoints #############################
 
-@app.route('/submit-PA', methods=['POST'])
-@limiter.limit("10 per hour")  # Max 10 submissions per hour per IP
 @log_execution_time
-def submit_purchApproval():
-    """Handle Purchase Approval submission"""
-    logger.info("purchase approval endpoint")
-    endpoint = 'Purchase Approval'
+def process_submission(endpoint, submissionReq):
+    """
+    Validate, record and notify one submission
+    Returns: (response body, http_code)
+    """
     try:
-        validation_result = validate_and_extract_input(endpoint, request)
+        validation_result = validate_and_extract_input(endpoint, submissionReq)
         if validation_result[0] == 0:
-            return jsonify({'error': validation_result[1]}), validation_result[2]
-        data = validation_result[1]            
+            return {'error': validation_result[1]}, validation_result[2]
+        data = validation_result[1]
 
-        submission_results = submission_handler_with_retry(data, request.files, endpoint)
+        submission_results = submission_handler(data, submissionReq.files, endpoint)
         if submission_results[0] == 0:
-            return jsonify({'error': submission_results[1]}), submission_results[2]
+            return {'error': submission_results[1]}, submission_results[2]
         results = submission_results[1]
         file_links = results["files_uploaded"]["list"]
-            
+
         # If we haven't returned before this point, submission is successful
-        # Try to run slack and email integrations
-        results['slack'] = send_slack_notification(data, file_links)
-        results['email'] = send_email_notification(endpoint, data, file_links)
-        
+        # Queue the form's slack and email integrations (sent in the background when the outbox is enabled)
+        results.update(send_notifications(endpoint, data, file_links))
+
         message = build_return_message(results, endpoint)
 
-        return jsonify({
+        return {
             'message': message,
             'details': results
-        }), 200
+        }, 200
 
     except Exception as e:
-        # print(f"Error processing Purchase Approval submission: {e}")
-        logger.error("Error Occurred", extra={'error processing Purchase Approval submission':str(e)}, exc_info=True)
-        return jsonify({'error': 'Internal server error'}), 500
+        logger.error("Error Occurred", extra={f'error processing {endpoint} submission':str(e)}, exc_info=True)
+        return {'error': 'Internal server error'}, 500
+
+def submit_form(endpoint):
+    """
+    Run the submission in the current request. With an Idempotency-Key header, a repeat of an
+    earlier submission gets the original response instead of being processed again.
+    """
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        body, status = process_submission(endpoint, request)
+        return jsonify(body), status
+
+    fingerprint = idempotency.request_fingerprint(endpoint, request.form, request.files)
+    body, status, replayed = idempotency.run_idempotent(
+        endpoint, key, fingerprint, lambda: process_submission(endpoint, request))
+    response = jsonify(body)
+    if replayed:
+        logger.info("replayed idempotent response", extra={'endpoint': endpoint})
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response, status
+
+@app.route('/submit-PA', methods=['POST'])
+@limiter.limit(SUBMISSION_RATE_LIMIT)
+@log_execution_time
+def submit_purchApproval():
+    """Handle Purchase Approval submission"""
+    logger.info("purchase approval endpoint")
+    return submit_form('Purchase Approval')
 
 @app.route('/submit', methods=['POST'])
-@limiter.limit("10 per hour")  # Max 10 submissions per hour per IP
+@limiter.limit(SUBMISSION_RATE_LIMIT)
 @log_execution_time
 def submit_reimbursement():
     """Handle reimbursement submission"""
     logger.info("reimbursement request endpoint")
-    endpoint = 'Reimbursement Request'
-    try:
-        validation_result = validate_and_extract_input(endpoint, request)
-        if validation_result[0] == 0:
-            return jsonify({'error': validation_result[1]}), validation_result[2]
-        data = validation_result[1]            
-
-        submission_results = submission_handler_with_retry(data, request.files, endpoint)
-        if submission_results[0] == 0:
-            return jsonify({'error': submission_results[1]}), submission_results[2]
-        results = submission_results[1]
-        file_links = results["files_uploaded"]["list"]
-
-        # If we haven't returned before this point, submission is successful
-        # Try to run email integration (no Slack for RR currently)
-        results['slack'] = True  # We currently only bother sending PAs to a channel
-        results['email'] = send_email_notification(endpoint, data, file_links)
-        
-        message = build_return_message(results, endpoint)
-
-        return jsonify({
-            'message': message,
-            'details': results
-        }), 200
-                
-    except Exception as e:
-        # print(f"Error processing Reimbursement Request submission: {e}")
-        logger.error("Error Occurred", extra={'error processing Reimbursement Request submission':str(e)}, exc_info=True)
-        return jsonify({'error': 'Internal server error'}), 500
+    return submit_form('Reimbursement Request')
 
 @app.route('/health', methods=['GET'])
+@limiter.exempt
 def health_check():
     """Health check endpoint"""
     logger.info("reimbursement request endpoint")
     return jsonify({'status': 'healthy'}), 200
 
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
 @app.route('/api/test-logger')
 def test_logger():
     logger.info("Test route called")
@@ -0,0 +1,124 @@
+"""
+Async (ASGI) serving mode for the submission endpoints.
+
+Serves /submit, /submit-PA, /health and /metrics from an asyncio event loop. Request bodies are
+read without holding a thread, so slow uploads don't tie up workers. The submission pipeline
+is shared with the Flask app in app.py and runs on the services thread pool (services.aio),
+one thread per submission, so at most ASYNC_IO_THREADS submissions are processed at once.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 8080 --proxy-headers
+"""
+import functools
+import uuid
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from werkzeug.datastructures import FileStorage, MultiDict
+
+from app import process_submission as app_process_submission, SUBMISSION_RATE_LIMIT
+from config import Config
+from services import aio, idempotency
+from services.logger import logger
+from services.metrics import HTTP_REQUESTS, HTTP_REQUEST_SECONDS, CONTENT_TYPE, render_metrics
+from services.ratelimit import RequestLimiter
+from services.tracing import start_trace, end_trace, log_trace
+
+# Same per-client submission limit as the Flask app, also only outside development.
+# /health and /metrics are not limited
+if Config.FLASK_ENV != 'development':
+    limiter = RequestLimiter(SUBMISSION_RATE_LIMIT, Config.RATELIMIT_STORAGE_URI, Config.RATELIMIT_STRATEGY)
+else:
+    limiter = None
+
+def client_address(request):
+    """Client IP as the Flask app sees it behind ProxyFix(x_for=1): the last X-Forwarded-For hop"""
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded:
+        return forwarded.split(',')[-1].strip()
+    return request.client.host if request.client else '127.0.0.1'
+
+class SubmissionRequest:
+    """The parts of a flask.Request that the submission pipeline reads, built from a Starlette form"""
+    def __init__(self, form):
+        self.form = MultiDict()
+        self.files = MultiDict()
+        for key, value in form.multi_items():
+            if isinstance(value, str):
+                self.form.add(key, value)
+            else:
+                self.files.add(key, FileStorage(stream=value.file, filename=value.filename,
+                                                name=key, content_type=value.content_type))
+
+async def handle_submission(request, endpoint):
+    trace, token = start_trace(str(uuid.uuid4()))
+    try:
+        # checked before the form is read, so rejected requests cost no parsing
+        if limiter and not await aio.run_sync(limiter.hit, client_address(request), request.url.path):
+            logger.warning("rate limit exceeded", extra={'endpoint': endpoint})
+            response = JSONResponse({'error': f'Rate limit exceeded: {SUBMISSION_RATE_LIMIT}'}, status_code=429)
+        else:
+            response = await process_submission(request, endpoint)
+    finally:
+        end_trace(token)
+    response.headers['Server-Timing'] = trace.server_timing()
+    log_trace(trace, method=request.method, path=request.url.path, status=response.status_code)
+    HTTP_REQUESTS.inc(path=request.url.path, method=request.method, status=response.status_code)
+    HTTP_REQUEST_SECONDS.observe(trace.elapsed_ms() / 1000, path=request.url.path)
+    return response
+
+async def process_submission(request, endpoint):
+    form = await request.form()
+    try:
+        # The form is read on the event loop; the pipeline itself (captcha, validation, uploads,
+        # sheet write, notifications) is the Flask app's and holds one services thread throughout
+        submission = SubmissionRequest(form)
+        process = functools.partial(app_process_submission, endpoint, submission)
+
+        # a repeat of an earlier submission with the same Idempotency-Key gets the original response
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            body, status = await aio.run_sync(process)
+            return JSONResponse(body, status_code=status)
+
+        fingerprint = idempotency.request_fingerprint(endpoint, submission.form, submission.files)
+        body, status, replayed = await aio.run_sync(idempotency.run_idempotent, endpoint, key, fingerprint, process)
+        response = JSONResponse(body, status_code=status)
+        if replayed:
+            response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    except Exception as e:
+        logger.error("Error Occurred", extra={f'error processing {endpoint} submission':str(e)}, exc_info=True)
+        return JSONResponse({'error': 'Internal server error'}, status_code=500)
+    finally:
+        await form.close()
+
+async def submit_purchApproval(request):
+    """Handle Purchase Approval submission"""
+    return await handle_submission(request, 'Purchase Approval')
+
+async def submit_reimbursement(request):
+    """Handle reimbursement submission"""
+    return await handle_submission(request, 'Reimbursement Request')
+
+async def health_check(request):
+    """Health check endpoint"""
+    return JSONResponse({'status': 'healthy'})
+
+async def metrics(request):
+    """Prometheus scrape endpoint"""
+    return Response(render_metrics(), media_type=CONTENT_TYPE)
+
+app = Starlette(
+    routes=[
+        Route('/submit-PA', submit_purchApproval, methods=['POST']),
+        Route('/submit', submit_reimbursement, methods=['POST']),
+        Route('/health', health_check, methods=['GET']),
+        Route('/metrics', metrics, methods=['GET']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])]
+)
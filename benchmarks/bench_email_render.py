@@ -0,0 +1,66 @@
+"""
+Render time per submission (list + acknowledgment emails) before and after the shared
+Jinja environment.
+
+Usage (from the repo root):
+    python -m benchmarks.bench_email_render
+"""
+import os
+import timeit
+
+from jinja2 import Template
+
+from services import notifications
+
+ENDPOINT = "Reimbursement Request"
+ROUNDS = 200
+
+
+def _submission(expense_count):
+    data = {
+        'id': 20250001,
+        'firstName': 'Ada',
+        'lastName': 'Lovelace',
+        'email': 'ada@example.com',
+        'comments': 'Benchmark submission',
+        'expenses': [{
+            'approval': 'Laser cutter',
+            'vendor': 'Acme',
+            'description': f'Item {i}',
+            'amount': 12.5,
+            'hst': 'HST included in amount'
+        } for i in range(expense_count)]
+    }
+    file_links = [f'https://drive.google.com/file/d/{i}/view' for i in range(expense_count)]
+    return data, file_links
+
+
+def _legacy_render(data, file_links):
+    """What send_email_notification used to do: read and compile the template per email"""
+    for email_type in ("list", "acknowledgment"):
+        total = sum(float(exp.get('amount', 0) or 0) for exp in data['expenses'])
+        with open(os.path.join(notifications.TEMPLATE_DIR, 'email_template.html')) as f:
+            template = Template(f.read())
+        template.render(email_type=email_type, form_type=ENDPOINT, message='',
+                        first_name=data['firstName'], last_name=data['lastName'], email=data['email'],
+                        timestamp='', expenses=data['expenses'], total=total,
+                        comments=data['comments'], file_links=file_links)
+
+
+def _current_render(data, file_links):
+    context = notifications.build_email_context(ENDPOINT, data, file_links)
+    for email_type in ("list", "acknowledgment"):
+        notifications.email_builder(ENDPOINT, data, file_links, email_type, context)
+
+
+def main():
+    print(f"{'expenses':>8} {'per-render compile':>20} {'shared environment':>20}")
+    for expense_count in (1, 10, 50):
+        data, file_links = _submission(expense_count)
+        legacy = timeit.timeit(lambda: _legacy_render(data, file_links), number=ROUNDS) / ROUNDS
+        current = timeit.timeit(lambda: _current_render(data, file_links), number=ROUNDS) / ROUNDS
+        print(f"{expense_count:>8} {legacy * 1000:>18.3f}ms {current * 1000:>18.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Checks that each RATELIMIT_STORAGE_URI backend enforces one limit across workers, and times a hit.
+
+Two limiters on the same storage stand in for two gunicorn workers (or two instances):
+with shared storage they must allow SUBMISSION_RATE_LIMIT between them, not twice it.
+memory:// is included for comparison and is expected to allow twice the limit.
+
+redis:// is checked against the server given with --redis, or, without it, against an
+in-process stand-in: fakeredis behind redis-py's connection pool, so the same `limits`
+Redis storage and Lua scripts run, only without the network hop.
+
+Requires redis, and fakeredis[lua] for the stand-in (pip install redis "fakeredis[lua]").
+Usage (from the repo root):
+    python -m benchmarks.bench_ratelimit [--redis redis://host:6379]
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+import uuid
+
+from limits import parse
+from limits.storage import storage_from_string
+from limits.strategies import STRATEGIES
+
+from app import SUBMISSION_RATE_LIMIT
+from config import Config
+import services.ratelimit  # registers the sqlite:// scheme
+
+TIMED_HITS = 2000
+
+
+def redis_stand_in():
+    """Storage factory for `limits`' Redis storage backed by one in-process fakeredis server"""
+    import redis
+    from fakeredis import FakeConnection, FakeServer
+    pool = redis.ConnectionPool(connection_class=FakeConnection, server=FakeServer())
+    return lambda: storage_from_string('redis://stand-in', connection_pool=pool)
+
+
+def allowed_across_workers(new_storage, strategy, limit):
+    """Alternate hits between two limiters on the same storage, returns how many were allowed"""
+    workers = [STRATEGIES[strategy](new_storage()) for _ in range(2)]
+    client = str(uuid.uuid4())
+    return sum(workers[i % 2].hit(limit, client, '/submit') for i in range(limit.amount * 3))
+
+
+def time_hits(new_storage, strategy):
+    limiter = STRATEGIES[strategy](new_storage())
+    limit = parse(f"{TIMED_HITS * 2} per hour")
+    samples = []
+    for i in range(TIMED_HITS):
+        start = time.perf_counter()
+        limiter.hit(limit, f"bench-{i % 50}", '/submit')
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--redis', help="redis:// URI of a server to check instead of the local stand-in")
+    parser.add_argument('--strategy', default=Config.RATELIMIT_STRATEGY)
+    args = parser.parse_args()
+
+    limit = parse(SUBMISSION_RATE_LIMIT)
+    sqlite_path = os.path.join(tempfile.mkdtemp(), 'ratelimit.sqlite3')
+    storages = {
+        'memory': (lambda: storage_from_string('memory://'), limit.amount * 2),
+        'sqlite': (lambda: storage_from_string(f"sqlite:///{sqlite_path}"), limit.amount),
+        'redis': ((lambda: storage_from_string(args.redis)) if args.redis else redis_stand_in(), limit.amount),
+    }
+
+    print(f"limit {SUBMISSION_RATE_LIMIT}, strategy {args.strategy}, 2 workers")
+    print(f"{'storage':10} {'allowed':>8} {'expected':>9} {'p50':>9} {'p99':>9}")
+    failed = False
+    for name, (new_storage, expected) in storages.items():
+        allowed = allowed_across_workers(new_storage, args.strategy, limit)
+        samples = sorted(time_hits(new_storage, args.strategy))
+        p50 = statistics.median(samples) * 1e6
+        p99 = samples[int(len(samples) * 0.99)] * 1e6
+        print(f"{name:10} {allowed:>8} {expected:>9} {p50:>7.0f}us {p99:>7.0f}us")
+        failed |= allowed != expected
+
+    if failed:
+        raise SystemExit("a storage did not enforce the limit as expected")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Per-message latency of send_email_notification's SMTP step with and without the pool.
+
+Starts a local aiosmtpd sink that delays its EHLO reply to stand in for the network
+round trips of a real connect/STARTTLS/login, then sends the same messages on a new
+connection each time (the old behaviour) and through SMTPConnectionPool.
+
+Requires aiosmtpd (pip install aiosmtpd). Usage (from the repo root):
+    python -m benchmarks.bench_smtp_pool
+"""
+import asyncio
+import smtplib
+import statistics
+import time
+from email.mime.text import MIMEText
+
+from aiosmtpd.controller import Controller
+
+from services.notifications import SMTPConnectionPool
+
+HOST = '127.0.0.1'
+PORT = 8025
+HANDSHAKE_DELAY_SECONDS = 0.05
+MESSAGES = 50
+
+
+class SlowHandshakeSink:
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        await asyncio.sleep(HANDSHAKE_DELAY_SECONDS)
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        return '250 OK'
+
+
+def _message(i):
+    msg = MIMEText(f"<p>benchmark message {i}</p>", 'html')
+    msg['From'] = 'bench@example.com'
+    msg['To'] = 'list@example.com'
+    msg['Subject'] = f"benchmark {i}"
+    return msg
+
+
+def _send_unpooled(msg):
+    server = smtplib.SMTP(HOST, PORT)
+    server.send_message(msg)
+    server.quit()
+
+
+def _measure(send):
+    samples = []
+    for i in range(MESSAGES):
+        start = time.perf_counter()
+        send(_message(i))
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.95) - 1]
+
+
+def main():
+    controller = Controller(SlowHandshakeSink(), hostname=HOST, port=PORT)
+    controller.start()
+    try:
+        pool = SMTPConnectionPool(HOST, PORT, starttls=False)
+        print(f"{MESSAGES} messages, {HANDSHAKE_DELAY_SECONDS * 1000:.0f}ms simulated handshake")
+        for label, send in (('new connection', _send_unpooled), ('pooled', pool.send_message)):
+            p50, p95 = _measure(send)
+            print(f"  {label:<15} p50 {p50 * 1000:6.1f}ms  p95 {p95 * 1000:6.1f}ms")
+        pool.close()
+    finally:
+        controller.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Peak memory of one receipt upload: the old read-everything approach vs streaming chunks.
+
+Drives a real resumable Drive upload request against a mock http that reads each request
+body the way http.client sends it (in 8 KiB blocks), so every byte of the file is read as in
+production, and reports the tracemalloc peak for each approach.
+
+Usage (from the repo root):
+    python -m benchmarks.bench_upload_memory
+"""
+import io
+import math
+import os
+import tempfile
+import tracemalloc
+
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpMockSequence, MediaIoBaseUpload
+from werkzeug.datastructures import FileStorage
+
+from config import Config
+from services.google_drive import build_media_upload
+from services.validation import MAX_FILE_SIZE
+
+MB = 1024 * 1024
+SEND_BLOCK_SIZE = 8192      # http.client reads file-like request bodies this much at a time
+
+
+def _request_file(size):
+    """A FileStorage backed by a temp file, like werkzeug produces for large uploads"""
+    stream = tempfile.TemporaryFile()
+    block = os.urandom(MB)
+    for _ in range(size // MB):
+        stream.write(block)
+    stream.seek(0)
+    return FileStorage(stream=stream, filename='receipt.pdf', content_type='application/pdf')
+
+
+class DrainingHttpMock(HttpMockSequence):
+    """HttpMockSequence that consumes each request body, recording how many bytes it was sent"""
+
+    def __init__(self, iterable):
+        super().__init__(iterable)
+        self.body_sizes = []
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        sent = 0
+        if hasattr(body, 'read'):
+            for block in iter(lambda: body.read(SEND_BLOCK_SIZE), b''):
+                sent += len(block)
+        elif body:
+            sent = len(body)
+        self.body_sizes.append(sent)
+        return super().request(uri, method, None, headers, **kwargs)
+
+
+def _mock_http(size, chunksize):
+    chunks = math.ceil(size / chunksize)
+    responses = [({'status': '200', 'location': 'https://upload.example/session'}, b'')]
+    for i in range(1, chunks):
+        responses.append(({'status': '308', 'range': f'bytes=0-{i * chunksize - 1}'}, b''))
+    responses.append(({'status': '200'}, b'{"id": "file-id", "webViewLink": "https://drive/file-id"}'))
+    return DrainingHttpMock(responses)
+
+
+def _legacy_media(file_data):
+    return MediaIoBaseUpload(io.BytesIO(file_data.read()),
+                             mimetype=file_data.content_type, resumable=True)
+
+
+def _peak_upload(service, make_media, size):
+    file_data = _request_file(size)
+    tracemalloc.start()
+    media = make_media(file_data)
+    http = _mock_http(size, media.chunksize())
+    request = service.files().create(body={'name': 'receipt.pdf'}, media_body=media,
+                                     fields='id, webViewLink', supportsAllDrives=True)
+    result = None
+    while result is None:
+        _, result = request.next_chunk(http=http)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    file_data.stream.close()
+    # the first request starts the session with the metadata, the rest carry the file
+    sent = sum(http.body_sizes[1:])
+    assert sent == size, f"sent {sent} bytes of a {size} byte file"
+    return peak
+
+
+def main():
+    service = build('drive', 'v3', http=HttpMockSequence([]), cache_discovery=False)
+    size = MAX_FILE_SIZE
+    print(f"file size {size / MB:.0f}MB, chunk size {Config.DRIVE_UPLOAD_CHUNK_SIZE / MB:.2f}MB")
+    print(f"  read into BytesIO: peak {_peak_upload(service, _legacy_media, size) / MB:6.2f}MB")
+    print(f"  streamed chunks:   peak {_peak_upload(service, build_media_upload, size) / MB:6.2f}MB")
+
+
+if __name__ == '__main__':
+    main()
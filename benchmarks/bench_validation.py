@@ -0,0 +1,111 @@
+"""
+validate_form_data time per submission before and after the compiled schema validator,
+for submissions with 1, 50 and 500 expense lines.
+
+The legacy version below is the old field-by-field code: uncompiled regexes evaluated per
+field, three re.sub passes per text value, stopping at the first error.
+
+Usage (from the repo root):
+    python -m benchmarks.bench_validation
+"""
+import re
+import timeit
+
+from services import forms, validation
+
+ENDPOINT = "Reimbursement Request"
+ROUNDS = 50
+# brackets that aren't tags must come through sanitizing unchanged, as they did before
+STRAY_BRACKETS = ('Cables <1m long', '5 > 3 widgets', 'a->b adapter', '<$50')
+
+
+def _submission(expense_count):
+    return {
+        'firstName': 'Ada',
+        'lastName': '<b>Lovelace</b>',
+        'email': 'ada@example.com',
+        'comments': 'Benchmark   submission with   some extra   whitespace',
+        'expenses': [{
+            'approval': STRAY_BRACKETS[i % len(STRAY_BRACKETS)],
+            'vendor': 'Acme Supplies',
+            'description': f'Item {i} <i>(spare parts)</i>',
+            'amount': '12.50',
+            'hst': 'HST included in amount'
+        } for i in range(expense_count)]
+    }
+
+
+def _legacy_sanitize(text):
+    text = re.sub(r'<[^>]*>', '', str(text))
+    text = re.sub(r'javascript:', '', text, flags=re.IGNORECASE)
+    text = re.sub(r'on\w+\s*=', '', text, flags=re.IGNORECASE)
+    text = ' '.join(text.split())
+    return text.strip()
+
+
+def _legacy_text(text, field_name, max_length=validation.MAX_TEXT_FIELD_LENGTH, required=True):
+    if not text or not text.strip():
+        if required:
+            return False, f"{field_name} is required"
+        return True, ""
+    sanitized = _legacy_sanitize(text)
+    if len(sanitized) > max_length:
+        return False, f"{field_name} exceeds maximum length of {max_length} characters"
+    return True, sanitized
+
+
+def _legacy_validate(endpoint, data):
+    """What validate_form_data used to do"""
+    sanitized = {}
+    for key, label, max_length, required in (('firstName', 'First name', validation.MAX_NAME_LENGTH, True),
+                                             ('lastName', 'Last name', validation.MAX_NAME_LENGTH, True)):
+        valid, result = _legacy_text(data.get(key), label, max_length, required)
+        if not valid:
+            return False, result, None
+        sanitized[key] = result
+    email = data.get('email', '').strip()
+    if not re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', email):
+        return False, 'Invalid email address', None
+    sanitized['email'] = email
+    valid, result = _legacy_text(data.get('comments', ''), 'Comments', validation.MAX_COMMENTS_LENGTH, False)
+    if not valid:
+        return False, result, None
+    sanitized['comments'] = result
+
+    sanitized_expenses = []
+    for i, expense in enumerate(data['expenses'], 1):
+        sanitized_expense = {}
+        for key, label in (('vendor', 'Vendor'), ('description', 'Description')):
+            valid, result = _legacy_text(expense.get(key), f'{label} (expense {i})')
+            if not valid:
+                return False, result, None
+            sanitized_expense[key] = result
+        valid, result = validation.validate_decimal(expense.get('amount'), f'Amount (expense {i})')
+        if not valid:
+            return False, result, None
+        sanitized_expense['amount'] = result
+        if endpoint == "Reimbursement Request":
+            valid, result = _legacy_text(expense.get('approval'), f'Approval/Project (expense {i})')
+            if not valid:
+                return False, result, None
+            sanitized_expense['approval'] = result
+            if expense.get('hst', '') not in ['HST included in amount', 'HST excluded from amount', 'HST not charged']:
+                return False, f'Invalid HST value (expense {i})', None
+            sanitized_expense['hst'] = expense['hst']
+        sanitized_expenses.append(sanitized_expense)
+    sanitized['expenses'] = sanitized_expenses
+    return True, "", sanitized
+
+
+def main():
+    print(f"{'expenses':>8} {'legacy':>12} {'compiled':>12}")
+    for expense_count in (1, 50, 500):
+        data = _submission(expense_count)
+        assert _legacy_validate(ENDPOINT, data) == forms.validate_form_data(ENDPOINT, data)
+        legacy = timeit.timeit(lambda: _legacy_validate(ENDPOINT, data), number=ROUNDS) / ROUNDS
+        current = timeit.timeit(lambda: forms.validate_form_data(ENDPOINT, data), number=ROUNDS) / ROUNDS
+        print(f"{expense_count:>8} {legacy * 1000:>10.3f}ms {current * 1000:>10.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
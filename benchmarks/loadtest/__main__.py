@@ -0,0 +1,300 @@
+"""
+End-to-end load test of /submit and /submit-PA against local fakes of every external service.
+
+Starts the fakes (benchmarks/loadtest/fakes.py), points the app's config at them, serves the
+Flask app (or the ASGI app with --server asgi) in-process, then fires multipart submissions
+from --concurrency client threads. Reports latency percentiles and throughput per endpoint,
+what each fake served, voided ID reservations (the cost of failed submissions now that IDs
+can't race) and any duplicate IDs found in the fake sheets (should always be none).
+
+Requires aiosmtpd, plus uvicorn for --server asgi. Usage (from the repo root):
+    python -m benchmarks.loadtest --requests 500 --concurrency 32 --google-latency 120
+    python -m benchmarks.loadtest --server asgi --concurrency 200 --error-rate 0.02
+    python -m benchmarks.loadtest --env SHEETS_GROUP_COMMIT=true --env NOTIFICATION_OUTBOX=false
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import socket
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from .fakes import HOST, Behaviour, FakeCaptcha, FakeGoogleAPIs, FakeSlack, FakeWorksheet, SMTPSink
+
+ENDPOINTS = {'Reimbursement Request': '/submit', 'Purchase Approval': '/submit-PA'}
+RR_SHEET, PA_SHEET = 'rr-loadtest', 'pa-loadtest'
+HST_OPTIONS = ['HST included in amount', 'HST excluded from amount', 'HST not charged']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.loadtest', description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask')
+    parser.add_argument('--requests', type=int, default=200, help='submissions to send')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--warmup', type=int, default=4, help='submissions sent before measuring')
+    parser.add_argument('--pa-share', type=float, default=0.5, help='fraction of submissions that are purchase approvals')
+    parser.add_argument('--max-expenses', type=int, default=3)
+    parser.add_argument('--max-files', type=int, default=2)
+    parser.add_argument('--file-kb', type=int, default=300, help='max receipt size (sizes are uniform up to this)')
+    parser.add_argument('--google-latency', type=float, default=80, help='ms per Sheets/Drive call')
+    parser.add_argument('--captcha-latency', type=float, default=60, help='ms per siteverify call')
+    parser.add_argument('--slack-latency', type=float, default=40, help='ms per webhook call')
+    parser.add_argument('--smtp-latency', type=float, default=40, help='ms per message')
+    parser.add_argument('--jitter', type=float, default=0.5, help='random extra latency, as a fraction of the base')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of fake calls that fail')
+    parser.add_argument('--drain', type=float, default=15, help='max seconds to wait for background deliveries')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='extra app config')
+    parser.add_argument('--verbose', action='store_true', help='keep the app logging')
+    return parser.parse_args()
+
+
+def behaviour(args, latency):
+    return Behaviour(latency, latency * args.jitter, args.error_rate)
+
+
+def fake_service_account(token_uri):
+    """Service account JSON with a throwaway key, so google-auth signs real JWTs for the fake token endpoint"""
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption()).decode()
+    except ImportError:
+        import rsa
+        pem = rsa.newkeys(2048)[1].save_pkcs1().decode()
+    return json.dumps({
+        'type': 'service_account',
+        'project_id': 'loadtest',
+        'private_key_id': uuid.uuid4().hex,
+        'private_key': pem,
+        'client_email': 'loadtest@loadtest.iam.gserviceaccount.com',
+        'client_id': '1',
+        'token_uri': token_uri,
+    })
+
+
+def start_fakes(args):
+    year = datetime.now().year
+    fakes = {
+        'google': FakeGoogleAPIs(behaviour(args, args.google_latency), {
+            RR_SHEET: FakeWorksheet('Reimbursements', [['ID', 'Timestamp', 'First Name', 'Last Name'], [year * 10000 + 1, 'seed']]),
+            PA_SHEET: FakeWorksheet('Approvals', [['ID', 'Timestamp', 'First Name', 'Last Name'], ['PA0001', 'seed']]),
+        }),
+        'captcha': FakeCaptcha(behaviour(args, args.captcha_latency)),
+        'slack': FakeSlack(behaviour(args, args.slack_latency)),
+        'smtp': SMTPSink(behaviour(args, args.smtp_latency)),
+    }
+    for fake in fakes.values():
+        fake.start()
+    return fakes
+
+
+def configure_app(args, fakes, workdir):
+    """Environment for config.py, which has to be set before the app is imported"""
+    google = fakes['google'].url
+    os.environ.update({
+        'FLASK_ENV': 'development',
+        'CAPTCHA_SECRET': 'loadtest',
+        'HCAPTCHA_VERIFY_URL': f"{fakes['captcha'].url}/siteverify",
+        'SLACK_WEBHOOK_URL': f"{fakes['slack'].url}/services/loadtest",
+        'DEV_OUTBOUND_EMAIL_ADDRESS': 'forms@loadtest.example.com',
+        'DEV_RECIPIENT_EMAIL': 'treasurer@loadtest.example.com',
+        'EMAIL_PASSWORD': 'loadtest',
+        'SMTP_SERVER': HOST,
+        'SMTP_PORT': str(fakes['smtp'].port),
+        'SMTP_STARTTLS': 'false',
+        'GOOGLE_API_BASE_URL': google,
+        'GOOGLE_SHEETS_CREDENTIALS': fake_service_account(f"{google}/token"),
+        'RR_SHEET_ID': RR_SHEET,
+        'PA_SHEET_ID': PA_SHEET,
+        'RR_WORKSHEET_NAME': 'Reimbursements',
+        'PA_WORKSHEET_NAME': 'Approvals',
+        'RR_GOOGLE_DRIVE_FOLDER_ID': 'rr-folder',
+        'PA_GOOGLE_DRIVE_FOLDER_ID': 'pa-folder',
+        'OUTBOX_DB_PATH': os.path.join(workdir, 'outbox.sqlite3'),
+        'JOURNAL_DB_PATH': os.path.join(workdir, 'journal.sqlite3'),
+        'OUTBOX_POLL_INTERVAL': '1',
+        'JOURNAL_POLL_INTERVAL': '1',
+        'HTTP_POOL_SIZE': str(max(8, args.concurrency)),
+        'RATELIMIT_STORAGE_URI': 'memory://',
+    })
+    for item in args.env:
+        key, _, value = item.partition('=')
+        os.environ[key] = value
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def start_app(args):
+    """Serve the app on a free local port in a background thread, returns its base URL"""
+    port = free_port()
+    # The submission routes stay rate limited in development (and --env can switch to
+    # production), but the load test measures the pipeline, not the limiter
+    import app as flask_app
+    flask_app.limiter.enabled = False
+    if args.server == 'asgi':
+        import uvicorn
+        import asgi
+        asgi.limiter = None
+        server = uvicorn.Server(uvicorn.Config(asgi.app, host=HOST, port=port, log_level='warning'))
+        threading.Thread(target=server.run, name='uvicorn', daemon=True).start()
+        while not server.started:
+            time.sleep(0.05)
+    else:
+        from werkzeug.serving import make_server
+        server = make_server(HOST, port, flask_app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, name='werkzeug', daemon=True).start()
+
+    if not args.verbose:
+        logging.getLogger('form_app').setLevel(logging.CRITICAL)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    return f"http://{HOST}:{port}"
+
+
+class SubmissionFactory:
+    """Realistic multipart bodies: a few expense lines and PDF-ish receipts of varying size"""
+    def __init__(self, args):
+        self.args = args
+        self._blob = b'%PDF-1.4\n' + os.urandom(args.file_kb * 1024)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def next(self):
+        with self._lock:
+            self._count += 1
+            n = self._count
+        endpoint = 'Purchase Approval' if random.random() < self.args.pa_share else 'Reimbursement Request'
+        expenses = []
+        for i in range(random.randint(1, self.args.max_expenses)):
+            expense = {'id': i + 1, 'vendor': f'Vendor {i}', 'description': f'Load test item {i}',
+                       'amount': f'{random.uniform(1, 500):.2f}'}
+            if endpoint == 'Reimbursement Request':
+                expense.update({'approval': 'Load test', 'hst': random.choice(HST_OPTIONS)})
+            expenses.append(expense)
+        form = {
+            'firstName': 'Load',
+            'lastName': f'Test{n}',
+            'email': f'load{n}@loadtest.example.com',
+            'comments': 'Submitted by the load-test harness',
+            'expenses': json.dumps(expenses),
+            'captchaToken': uuid.uuid4().hex,
+        }
+        files = {}
+        for i in range(random.randint(0, self.args.max_files)):
+            size = random.randint(16 * 1024, max(16, self.args.file_kb) * 1024)
+            files[f'file{i}'] = (f'receipt-{n}-{i}.pdf', self._blob[:size], 'application/pdf')
+        return endpoint, form, files
+
+
+def run_load(args, base_url, factory, total):
+    import requests
+    local = threading.local()
+
+    def submit(_):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        endpoint, form, files = factory.next()
+        start = time.perf_counter()
+        try:
+            response = session.post(base_url + ENDPOINTS[endpoint], data=form, files=files, timeout=300)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = type(e).__name__
+        return endpoint, status, time.perf_counter() - start
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(submit, range(total)))
+    elapsed = time.perf_counter() - started
+
+    limited = sum(1 for r in results if r[1] == 429)
+    if limited:
+        raise SystemExit(f"{limited} of {total} submissions were rate limited (429), "
+                         "so the results would measure the limiter rather than the pipeline")
+    return results, elapsed
+
+
+def percentile(samples, p):
+    """Nearest-rank percentile of sorted samples"""
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+
+def wait_for_deliveries(fakes, seconds):
+    """Let the notification outbox / sheet journal catch up, until the fakes go quiet"""
+    deadline = time.monotonic() + seconds
+    last = None
+    while time.monotonic() < deadline:
+        current = (sum(fakes['google'].requests.values()), len(fakes['slack'].messages), fakes['smtp'].messages)
+        if current == last:
+            return
+        last = current
+        time.sleep(1)
+
+
+def report(args, results, elapsed, fakes):
+    print(f"\n{args.requests} submissions, {args.concurrency} concurrent, {args.server} server, "
+          f"{args.error_rate:.1%} fake error rate, {elapsed:.1f}s")
+    print(f"{'endpoint':<22}{'n':>6}{'ok':>6}{'req/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  statuses")
+    groups = [(name, [r for r in results if r[0] == name]) for name in ENDPOINTS] + [('all', results)]
+    for name, rows in groups:
+        if not rows:
+            continue
+        latencies = sorted(r[2] * 1000 for r in rows)
+        ok = sum(1 for r in rows if r[1] == 200)
+        statuses = ', '.join(f"{status}: {count}" for status, count in sorted(Counter(r[1] for r in rows).items(), key=str))
+        print(f"{name:<22}{len(rows):>6}{ok:>6}{len(rows) / elapsed:>8.1f}"
+              f"{percentile(latencies, 50):>7.0f}ms{percentile(latencies, 95):>7.0f}ms"
+              f"{percentile(latencies, 99):>7.0f}ms{latencies[-1]:>7.0f}ms  {statuses}")
+    print(f"  mean {statistics.mean(r[2] for r in results) * 1000:.0f}ms")
+
+    google = fakes['google']
+    print("\nfake google apis:")
+    for route, count in sorted(google.requests.items()):
+        print(f"  {count:>7}  {route}")
+    print(f"  uploaded {google.uploaded_bytes / 1024 / 1024:.1f} MiB, deleted {google.deleted} files (rollbacks)")
+    print(f"  voided reservations (rows): {google.void_rows()}")
+    print(f"  duplicate ids: {google.duplicate_ids()}")
+    print(f"captcha verifications: {sum(fakes['captcha'].requests.values())}, "
+          f"slack messages: {len(fakes['slack'].messages)}, emails: {fakes['smtp'].messages}")
+
+
+def main():
+    args = parse_args()
+    fakes = start_fakes(args)
+    with tempfile.TemporaryDirectory(prefix='loadtest-') as workdir:
+        configure_app(args, fakes, workdir)
+        base_url = start_app(args)
+        factory = SubmissionFactory(args)
+        if args.warmup:
+            run_load(args, base_url, factory, args.warmup)      # tokens, clients, worksheet handles
+            wait_for_deliveries(fakes, args.drain)
+        for fake in (fakes['google'], fakes['captcha'], fakes['slack']):
+            fake.requests.clear()
+        fakes['slack'].messages.clear()
+        fakes['smtp'].messages = 0
+
+        results, elapsed = run_load(args, base_url, factory, args.requests)
+        wait_for_deliveries(fakes, args.drain)
+        report(args, results, elapsed, fakes)
+
+        for fake in fakes.values():
+            fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,422 @@
+"""
+In-process stand-ins for every service the backend talks to: Google OAuth token endpoint,
+Sheets v4, Drive v3 (folders, resumable uploads, deletes and batch requests), hCaptcha
+siteverify, a Slack webhook and an SMTP sink. Each one injects latency and errors according
+to its Behaviour, and counts what it served.
+"""
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+HOST = '127.0.0.1'
+
+
+class Behaviour:
+    """Latency (base + uniform jitter, in ms) and error rate applied to each request"""
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+
+    def delay(self):
+        return (self.latency_ms + random.uniform(0, self.jitter_ms)) / 1000
+
+    def should_fail(self):
+        return random.random() < self.error_rate
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'       # keep-alive, like the real services
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        body = self._body()
+        self.server.fake.count(self.command, url.path)
+        self.server.fake.handle(self, self.command, url.path, parse_qs(url.query), body)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _dispatch
+
+
+class FakeServer:
+    """A threaded HTTP server on a free local port, routed to self.handle"""
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.requests = {}
+        self._count_lock = threading.Lock()
+        self._server = ThreadingHTTPServer((HOST, 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://{HOST}:{self._server.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, method, path):
+        path = re.sub(r'/values/[^:]+', '/values/{range}', path)
+        key = f"{method} {re.sub(r'/[A-Za-z0-9_-]{16,}', '/{id}', path)}"
+        with self._count_lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def handle(self, handler, method, path, query, body):
+        raise NotImplementedError
+
+
+class FakeCaptcha(FakeServer):
+    """hCaptcha siteverify, every token passes"""
+    def handle(self, handler, method, path, query, body):
+        time.sleep(self.behaviour.delay())
+        if self.behaviour.should_fail():
+            return handler._reply(500, 'internal error', 'text/plain')
+        handler._reply(200, {'success': True, 'challenge_ts': datetime.utcnow().isoformat()})
+
+
+class FakeSlack(FakeServer):
+    """Incoming webhook, stores the posted messages"""
+    def __init__(self, behaviour):
+        super().__init__(behaviour)
+        self.messages = []
+
+    def handle(self, handler, method, path, query, body):
+        time.sleep(self.behaviour.delay())
+        if self.behaviour.should_fail():
+            return handler._reply(500, 'internal_error', 'text/plain')
+        self.messages.append(json.loads(body or b'{}'))
+        handler._reply(200, 'ok', 'text/plain')
+
+
+_A1 = re.compile(r"^(?:(?:'(?P<quoted>(?:[^']|'')+)'|(?P<title>[^!]+))!)?"
+                 r"\$?(?P<c1>[A-Z]+)\$?(?P<r1>\d+)?(?::\$?(?P<c2>[A-Z]+)\$?(?P<r2>\d+)?)?$")
+_PREVIOUS_ID = 'INDIRECT("R[-1]C",FALSE)'
+
+
+def _col_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index
+
+
+def _col_letters(index):
+    letters = ''
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+class FakeWorksheet:
+    """Rows of computed cell values; formulas are evaluated once, when written"""
+    def __init__(self, title, rows, sheet_id=0, row_count=1000, col_count=26):
+        self.title = title
+        self.sheet_id = sheet_id
+        self.rows = [list(row) for row in rows]
+        self.row_count = row_count
+        self.col_count = col_count
+
+    def properties(self):
+        return {'sheetId': self.sheet_id, 'title': self.title, 'index': self.sheet_id, 'sheetType': 'GRID',
+                'gridProperties': {'rowCount': max(self.row_count, len(self.rows)), 'columnCount': self.col_count}}
+
+    def cell(self, row, col):
+        if 1 <= row <= len(self.rows) and col <= len(self.rows[row - 1]):
+            return self.rows[row - 1][col - 1]
+        return ''
+
+    def _evaluate(self, row, col, value):
+        """USER_ENTERED: the two ID formulas used for reservations, plain numbers, else text"""
+        if not isinstance(value, str):
+            return value
+        if value.startswith('=') and _PREVIOUS_ID in value:
+            above = self.cell(row - 1, col)
+            if value == f'={_PREVIOUS_ID}':
+                return above
+            if value.startswith('="PA"'):
+                if isinstance(above, str) and above[:2] == 'PA' and above[2:].isdigit():
+                    return f"PA{int(above[2:]) + 1:04d}"
+                return '#VALUE!'
+            if not isinstance(above, int):
+                return '#VALUE!'
+            year = datetime.now().year
+            return year * 10000 + 1 if above // 10000 < year else above + 1
+        if re.fullmatch(r'-?\d+', value):
+            return int(value)
+        if re.fullmatch(r'-?\d+\.\d+', value):
+            return float(value)
+        return value
+
+    def write(self, row, col, values):
+        for r, row_values in enumerate(values, row):
+            while len(self.rows) < r:
+                self.rows.append([])
+            cells = self.rows[r - 1]
+            for c, value in enumerate(row_values, col):
+                while len(cells) < c:
+                    cells.append('')
+                cells[c - 1] = self._evaluate(r, c, value)
+
+    def last_row(self):
+        for r in range(len(self.rows), 0, -1):
+            if any(cell != '' for cell in self.rows[r - 1]):
+                return r
+        return 0
+
+    def read(self, row1, col1, row2, col2):
+        values = [[self.cell(r, c) for c in range(col1, col2 + 1)] for r in range(row1, row2 + 1)]
+        for row_values in values:       # the API trims trailing empty cells and rows
+            while row_values and row_values[-1] == '':
+                row_values.pop()
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+
+class FakeGoogleAPIs(FakeServer):
+    """
+    OAuth token endpoint, Sheets v4 and Drive v3 on one server. Point the app at it with
+    GOOGLE_API_BASE_URL, and a service account whose token_uri is f"{url}/token".
+    sheets: {spreadsheet_id: FakeWorksheet}
+    """
+    def __init__(self, behaviour, sheets):
+        super().__init__(behaviour)
+        self.sheets = sheets
+        self.lock = threading.Lock()
+        self.files = {}
+        self.uploads = {}
+        self.uploaded_bytes = 0
+        self.deleted = 0
+
+    # --- dispatch ---
+    def handle(self, handler, method, path, query, body):
+        if path == '/token':
+            # tokens are minted without latency or errors so they don't skew the numbers
+            return handler._reply(200, {'access_token': uuid.uuid4().hex, 'expires_in': 3600, 'token_type': 'Bearer'})
+
+        time.sleep(self.behaviour.delay())
+        if path.startswith('/batch/'):
+            return self._batch(handler, body)
+        if self.behaviour.should_fail():
+            return handler._reply(503, {'error': {'code': 503, 'message': 'The service is currently unavailable.',
+                                                  'status': 'UNAVAILABLE'}})
+        status, payload, headers = self.route(method, path, query, body, handler.headers)
+        handler._reply(status, payload, headers=headers)
+
+    def route(self, method, path, query, body, headers):
+        if path.startswith('/v4/spreadsheets/'):
+            return self._sheets(method, unquote(path[len('/v4/spreadsheets/'):]), body)
+        if path.startswith('/upload/drive/v3/files'):
+            return self._upload(method, query, body, headers)
+        if path.startswith('/drive/v3/files'):
+            return self._drive(method, path[len('/drive/v3/files'):].strip('/'), query, body)
+        return 404, {'error': {'code': 404, 'message': f'no fake for {method} {path}'}}, None
+
+    # --- sheets ---
+    def _sheets(self, method, rest, body):
+        spreadsheet_id, _, rest = rest.partition('/')
+        action = None
+        if ':' in spreadsheet_id:
+            spreadsheet_id, action = spreadsheet_id.split(':', 1)
+        sheet = self.sheets.get(spreadsheet_id)
+        if sheet is None:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.', 'status': 'NOT_FOUND'}}, None
+        request = json.loads(body) if body else {}
+
+        with self.lock:
+            if not rest and action is None:
+                return 200, {'spreadsheetId': spreadsheet_id, 'properties': {'title': spreadsheet_id, 'locale': 'en_US',
+                             'timeZone': 'America/Toronto'}, 'sheets': [{'properties': sheet.properties()}]}, None
+            if rest == 'values:batchUpdate':
+                for data in request.get('data', []):
+                    self._update(sheet, data['range'], data['values'])
+                return 200, {'spreadsheetId': spreadsheet_id, 'totalUpdatedRanges': len(request.get('data', []))}, None
+            if rest == 'values:batchClear':
+                for a1 in request.get('ranges', []):
+                    row1, col1, row2, col2 = self._bounds(sheet, a1)
+                    sheet.write(row1, col1, [[''] * (col2 - col1 + 1)] * (row2 - row1 + 1))
+                return 200, {'spreadsheetId': spreadsheet_id, 'clearedRanges': request.get('ranges', [])}, None
+
+            a1 = rest[len('values/'):]
+            if a1.endswith(':append'):
+                return 200, self._append(sheet, spreadsheet_id, request.get('values', [])), None
+            if method == 'PUT':
+                updated = self._update(sheet, a1, request.get('values', []))
+                return 200, {'spreadsheetId': spreadsheet_id, 'updatedRange': updated}, None
+            row1, col1, row2, col2 = self._bounds(sheet, a1)
+            values = [[str(cell) for cell in row] for row in sheet.read(row1, col1, row2, col2)]
+            return 200, {'range': a1, 'majorDimension': 'ROWS', 'values': values}, None
+
+    @staticmethod
+    def _bounds(sheet, a1):
+        match = _A1.match(a1)
+        col1 = _col_index(match['c1'])
+        row1 = int(match['r1'] or 1)
+        col2 = _col_index(match['c2'] or match['c1'])
+        row2 = int(match['r2'] or (match['r1'] if not match['c2'] else max(sheet.row_count, len(sheet.rows))))
+        return row1, col1, row2, col2
+
+    def _update(self, sheet, a1, values):
+        row1, col1, _, _ = self._bounds(sheet, a1)
+        sheet.write(row1, col1, values)
+        width = max((len(row) for row in values), default=1)
+        return f"'{sheet.title}'!{_col_letters(col1)}{row1}:{_col_letters(col1 + width - 1)}{row1 + len(values) - 1}"
+
+    def _append(self, sheet, spreadsheet_id, values):
+        start = sheet.last_row() + 1
+        updated = self._update(sheet, f"A{start}", values)
+        width = max((len(row) for row in values), default=1)
+        return {'spreadsheetId': spreadsheet_id, 'tableRange': f"'{sheet.title}'!A1:{_col_letters(width)}{start - 1}",
+                'updates': {'spreadsheetId': spreadsheet_id, 'updatedRange': updated, 'updatedRows': len(values),
+                            'updatedData': {'range': updated, 'majorDimension': 'ROWS',
+                                            'values': sheet.read(start, 1, start + len(values) - 1, width)}}}
+
+    # --- drive ---
+    def _new_file(self, name, parents, mime_type, size=0):
+        file_id = uuid.uuid4().hex
+        self.files[file_id] = {'name': name, 'parents': parents, 'mimeType': mime_type, 'size': size}
+        return {'id': file_id, 'webViewLink': f"https://drive.google.com/file/d/{file_id}/view"}
+
+    def _drive(self, method, file_id, query, body):
+        with self.lock:
+            if method == 'GET' and not file_id:
+                name = re.search(r"name='([^']*)'", query.get('q', [''])[0])
+                matches = [{'id': fid} for fid, f in self.files.items()
+                           if name and f['name'] == name.group(1) and f['mimeType'].endswith('folder')]
+                return 200, {'files': matches}, None
+            if method == 'POST' and not file_id:
+                metadata = json.loads(body or b'{}')
+                return 200, self._new_file(metadata.get('name'), metadata.get('parents', []),
+                                           metadata.get('mimeType', 'application/octet-stream')), None
+            if method == 'DELETE':
+                if self.files.pop(file_id, None) is None:
+                    return 404, {'error': {'code': 404, 'message': f'File not found: {file_id}.'}}, None
+                self.deleted += 1
+                return 204, b'', None
+        return 404, {'error': {'code': 404, 'message': f'no fake for {method} {file_id}'}}, None
+
+    def _upload(self, method, query, body, headers):
+        upload_id = query.get('upload_id', [None])[0]
+        with self.lock:
+            if method == 'POST':
+                upload_id = uuid.uuid4().hex
+                self.uploads[upload_id] = {'metadata': json.loads(body or b'{}'), 'received': 0}
+                location = f"{self.url}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+                return 200, b'', {'Location': location}
+
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                return 404, {'error': {'code': 404, 'message': 'upload session not found'}}, None
+            upload['received'] += len(body)
+            self.uploaded_bytes += len(body)
+            # Content-Range: bytes <first>-<last>/<total>, total is '*' until the last chunk if unknown
+            total = (headers.get('Content-Range') or '').rpartition('/')[2]
+            if not total.isdigit() or upload['received'] < int(total):
+                return 308, b'', {'Range': f"bytes=0-{upload['received'] - 1}"}
+            del self.uploads[upload_id]
+            metadata = upload['metadata']
+            return 200, self._new_file(metadata.get('name'), metadata.get('parents', []),
+                                       'application/octet-stream', upload['received']), None
+
+    def _batch(self, handler, body):
+        """multipart/mixed batch of Drive requests, each part succeeds or fails on its own"""
+        content_type = handler.headers['Content-Type']
+        message = BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            request_line, _, _ = part.get_payload().partition('\n')
+            method, target, _ = request_line.strip().split(' ', 2)
+            url = urlparse(target)
+            if self.behaviour.should_fail():
+                status, payload = 503, {'error': {'code': 503, 'message': 'Backend Error'}}
+            else:
+                status, payload, _ = self.route(method, url.path, parse_qs(url.query), b'', {})
+            payload = json.dumps(payload) if isinstance(payload, dict) else ''
+            content_id = part['Content-ID'].strip('<>')
+            parts.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                         f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n"
+                         f"Content-Type: application/json; charset=UTF-8\r\n\r\n{payload}\r\n")
+        handler._reply(200, ''.join(parts) + f"--{boundary}--\r\n", f"multipart/mixed; boundary={boundary}")
+
+    def void_rows(self):
+        return {sid: sum(1 for row in sheet.rows if len(row) > 1 and row[1] == 'VOID')
+                for sid, sheet in self.sheets.items()}
+
+    def duplicate_ids(self):
+        """IDs that appear on rows of more than one submission (should always be empty)"""
+        duplicates = {}
+        for sid, sheet in self.sheets.items():
+            owners = {}
+            for row in sheet.rows[1:]:
+                if row and row[0] != '' and len(row) > 3 and row[1] not in ('VOID', 'PENDING'):
+                    owners.setdefault(row[0], set()).add(row[3])   # last name is unique per load-test submission
+            duplicates[sid] = [id_ for id_, seen in owners.items() if len(seen) > 1]
+        return duplicates
+
+
+class SMTPSink:
+    """aiosmtpd server accepting any login, delays DATA by the behaviour's latency"""
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.messages = 0
+        self.port = None
+        self._controller = None
+
+    async def handle_DATA(self, server, session, envelope):
+        await asyncio.sleep(self.behaviour.delay())
+        if self.behaviour.should_fail():
+            return '451 Requested action aborted: local error in processing'
+        self.messages += 1
+        return '250 OK'
+
+    def start(self):
+        import socket
+        from aiosmtpd.controller import Controller
+        from aiosmtpd.smtp import AuthResult
+
+        with socket.socket() as s:
+            s.bind((HOST, 0))
+            self.port = s.getsockname()[1]
+        self._controller = Controller(self, hostname=HOST, port=self.port, auth_require_tls=False,
+                                      authenticator=lambda *args: AuthResult(success=True))
+        self._controller.start()
+        return self
+
+    def stop(self):
+        self._controller.stop()
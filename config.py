@@ -5,35 +5,94 @@ load_dotenv()
 
 class Config:
     FLASK_ENV = os.environ.get('FLASK_ENV', 'production')
+
+    # logging
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    # start/completion lines from @log_execution_time: their level, the fraction of calls that
+    # log them, and a duration (ms) above which a call is always logged regardless of sampling
+    LOG_TIMING_LEVEL = os.environ.get('LOG_TIMING_LEVEL', 'INFO').upper()
+    LOG_TIMING_SAMPLE_RATE = float(os.environ.get('LOG_TIMING_SAMPLE_RATE', '1.0'))
+    LOG_SLOW_CALL_MS = float(os.environ.get('LOG_SLOW_CALL_MS', '1000'))
     HCAPTCHA_SECRET_KEY = os.environ.get('CAPTCHA_SECRET')
+    HCAPTCHA_VERIFY_URL = os.environ.get('HCAPTCHA_VERIFY_URL', 'https://hcaptcha.com/siteverify')
+    # seconds a used captcha token is remembered and rejected if submitted again
+    CAPTCHA_REPLAY_WINDOW = int(os.environ.get('CAPTCHA_REPLAY_WINDOW', '300'))
     SLACK_WEBHOOK_URL = os.environ.get('SLACK_WEBHOOK_URL')
 
     # email
     OUTBOUND_EMAIL_ADDRESS = os.environ.get('OUTBOUND_EMAIL_ADDRESS')
-    RECIPIENT_EMAIL = {
-        "Reimbursement Request": os.environ.get('RR_RECIPIENT_EMAIL'),
-        "Purchase Approval": os.environ.get('PA_RECIPIENT_EMAIL')
-    }
     DEV_OUTBOUND_EMAIL_ADDRESS = os.environ.get('DEV_OUTBOUND_EMAIL_ADDRESS')
     DEV_RECIPIENT_EMAIL = os.environ.get('DEV_RECIPIENT_EMAIL')
 
+    # notifications are queued in a local SQLite outbox and sent in the background
+    NOTIFICATION_OUTBOX = os.environ.get('NOTIFICATION_OUTBOX', 'true').lower() == 'true'
+    OUTBOX_DB_PATH = os.environ.get('OUTBOX_DB_PATH', 'outbox.sqlite3')
+    OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+    OUTBOX_POLL_INTERVAL = int(os.environ.get('OUTBOX_POLL_INTERVAL', '5'))
+
     EMAIL_PASSWORD = os.environ.get('EMAIL_PASSWORD')
     SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
     SMTP_PORT = int(os.environ.get('SMTP_PORT', '587'))
+    # logged-in SMTP connections kept open per sender, closed after SMTP_IDLE_TIMEOUT seconds unused
+    SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', '2'))
+    SMTP_IDLE_TIMEOUT = int(os.environ.get('SMTP_IDLE_TIMEOUT', '60'))
+    SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', 'true').lower() == 'true'
     
-    # google sheets for data backend, google drive for file uploads
-    GOOGLE_SHEET_ID = {
-        "Reimbursement Request": os.environ.get('RR_SHEET_ID'),
-        "Purchase Approval": os.environ.get('PA_SHEET_ID')
-    }
-    GOOGLE_WORKSHEET_NAME = {
-        "Reimbursement Request": os.environ.get('RR_WORKSHEET_NAME'),
-        "Purchase Approval": os.environ.get('PA_WORKSHEET_NAME')
-    }
-    GOOGLE_DRIVE_FOLDER = {
-        "Reimbursement Request": os.environ.get('RR_GOOGLE_DRIVE_FOLDER_ID'),
-        "Purchase Approval": os.environ.get('PA_GOOGLE_DRIVE_FOLDER_ID'),
-    }
+    # Idempotency-Key: responses kept for IDEMPOTENCY_TTL seconds (at most IDEMPOTENCY_MAX_KEYS), repeats
+    # wait up to IDEMPOTENCY_WAIT_TIMEOUT for a request still in flight; IDEMPOTENCY_DB_PATH shares keys via SQLite
+    IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', '86400'))
+    IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', '10000'))
+    IDEMPOTENCY_WAIT_TIMEOUT = int(os.environ.get('IDEMPOTENCY_WAIT_TIMEOUT', '120'))
+    IDEMPOTENCY_DB_PATH = os.environ.get('IDEMPOTENCY_DB_PATH', '')
+
+    # rate limit counters: sqlite:///path shares them between workers on a host, redis://host:6379
+    # between instances, memory:// keeps them per process
+    RATELIMIT_STORAGE_URI = os.environ.get('RATELIMIT_STORAGE_URI', 'sqlite:///ratelimit.sqlite3')
+    RATELIMIT_STRATEGY = os.environ.get('RATELIMIT_STRATEGY', 'sliding-window-counter')
+
+    # shared HTTP transport for Google APIs, pool size should match gunicorn --threads
+    HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '8'))
+    HTTP_TIMEOUT = int(os.environ.get('HTTP_TIMEOUT', '60'))
+    # send Google API calls (https://*.googleapis.com) to this base URL instead, e.g. the load-test fakes
+    GOOGLE_API_BASE_URL = os.environ.get('GOOGLE_API_BASE_URL', '')
+    # access tokens are refreshed in the background this many seconds before they expire
+    TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', '600'))
+    # ASGI mode (asgi.py): threads running the submission pipeline, i.e. max submissions processed at once
+    ASYNC_IO_THREADS = int(os.environ.get('ASYNC_IO_THREADS', '64'))
+
+    # max receipts uploaded to Drive at the same time (shared by all requests in a worker)
+    DRIVE_UPLOAD_CONCURRENCY = int(os.environ.get('DRIVE_UPLOAD_CONCURRENCY', '4'))
+    # bytes sent per resumable upload request (rounded down to a multiple of 256 KiB)
+    DRIVE_UPLOAD_CHUNK_SIZE = int(os.environ.get('DRIVE_UPLOAD_CHUNK_SIZE', str(4 * 1024 * 1024)))
+
+    # identical receipts are uploaded once: repeats in a submission reuse the upload, and a receipt uploaded
+    # by an earlier submission within DRIVE_DEDUP_WINDOW seconds gets a Drive shortcut (0 turns that off).
+    # The hash index is per worker; set DRIVE_DEDUP_INDEX_PATH to share it via SQLite
+    DRIVE_DEDUP_WINDOW = int(os.environ.get('DRIVE_DEDUP_WINDOW', str(7 * 24 * 3600)))
+    DRIVE_DEDUP_INDEX_SIZE = int(os.environ.get('DRIVE_DEDUP_INDEX_SIZE', '10000'))
+    DRIVE_DEDUP_INDEX_PATH = os.environ.get('DRIVE_DEDUP_INDEX_PATH', '')
+
+    # submission folder IDs cached per worker; set DRIVE_FOLDER_CACHE_PATH to share them via SQLite
+    DRIVE_FOLDER_CACHE_SIZE = int(os.environ.get('DRIVE_FOLDER_CACHE_SIZE', '256'))
+    DRIVE_FOLDER_CACHE_TTL = int(os.environ.get('DRIVE_FOLDER_CACHE_TTL', '86400'))
+    DRIVE_FOLDER_CACHE_PATH = os.environ.get('DRIVE_FOLDER_CACHE_PATH', '')
+
+    # google sheets for data backend, google drive for file uploads (per-form IDs: see form_setting)
+    # seconds a worksheet handle is reused before its metadata is fetched again
+    WORKSHEET_CACHE_TTL = int(os.environ.get('WORKSHEET_CACHE_TTL', '300'))
+    # group commit: sheet writes arriving within the window are sent together in one API call
+    SHEETS_GROUP_COMMIT = os.environ.get('SHEETS_GROUP_COMMIT', 'false').lower() == 'true'
+    SHEETS_GROUP_COMMIT_WINDOW_MS = int(os.environ.get('SHEETS_GROUP_COMMIT_WINDOW_MS', '100'))
+    SHEETS_GROUP_COMMIT_MAX_BATCH = int(os.environ.get('SHEETS_GROUP_COMMIT_MAX_BATCH', '20'))
+    # write-ahead journal: submissions are acknowledged once stored locally and copied to the sheet in the background
+    SUBMISSION_JOURNAL = os.environ.get('SUBMISSION_JOURNAL', 'false').lower() == 'true'
+    JOURNAL_DB_PATH = os.environ.get('JOURNAL_DB_PATH', 'journal.sqlite3')
+    JOURNAL_POLL_INTERVAL = int(os.environ.get('JOURNAL_POLL_INTERVAL', '5'))
+    JOURNAL_RETENTION = int(os.environ.get('JOURNAL_RETENTION', str(7 * 24 * 3600)))
     ORGANIZATION_DOMAIN = os.environ.get('ORGANIZATION_DOMAIN'),
     
-    
\ No newline at end of file
+    
+    @staticmethod
+    def form_setting(prefix, name):
+        """Per-form setting <prefix>_<name>, e.g. RR_SHEET_ID; each form in services/forms.py has a prefix"""
+        return os.environ.get(f'{prefix}_{name}')
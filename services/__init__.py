@@ -1,19 +1,37 @@
-from .google_sheets import add_to_google_sheet, get_next_id_from_google_sheet, is_id_unused
-from .google_drive import upload_to_google_drive, delete_from_google_drive
+from .google_sheets import reserve_id_in_google_sheet, fill_reserved_rows, release_reserved_id, count_rows
+from .google_drive import upload_to_google_drive, upload_files_to_google_drive, delete_from_google_drive, \
+        batch_delete_from_google_drive, rollback_receipts
 from .notifications import send_slack_notification, send_email_notification
+from .outbox import deliver_notification, start_outbox_dispatcher
+from .journal import write_submission_rows, start_journal_replicator, get_replication_stats
 from .google_auth import get_credentials
-from .validation import validate_form_data, validate_file, validate_total_file_size
+from .forms import FORMS, get_form, validate_form_data
+from .validation import validate_file, validate_total_file_size
+from .captcha import verify_hcaptcha, start_hcaptcha_verification
 
 __all__ = [
-    'add_to_google_sheet',
-    'get_next_id_from_google_sheet', 
     'upload_to_google_drive',
+    'upload_files_to_google_drive',
     'delete_from_google_drive',
+    'batch_delete_from_google_drive',
+    'rollback_receipts',
     'send_slack_notification',
     'send_email_notification',
+    'deliver_notification',
+    'start_outbox_dispatcher',
+    'write_submission_rows',
+    'start_journal_replicator',
+    'get_replication_stats',
     'get_credentials',
-    'is_id_unused',
+    'reserve_id_in_google_sheet',
+    'fill_reserved_rows',
+    'release_reserved_id',
+    'count_rows',
+    'FORMS',
+    'get_form',
     'validate_form_data',
     'validate_file',
-    'validate_total_file_size'
+    'validate_total_file_size',
+    'verify_hcaptcha',
+    'start_hcaptcha_verification'
 ]
\ No newline at end of file
@@ -0,0 +1,19 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+
+# Async adapters around the (blocking) services package for the ASGI app in asgi.py.
+# Calls run on a dedicated thread pool sized by ASYNC_IO_THREADS rather than asyncio's small
+# default one, and carry the caller's context variables with them. The sync functions are
+# unchanged, so the Flask app keeps calling them directly.
+
+_executor = ThreadPoolExecutor(max_workers=Config.ASYNC_IO_THREADS, thread_name_prefix='aio')
+
+async def run_sync(func, *args, **kwargs):
+    """Run a blocking function on the services thread pool and await its result"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(context.run, func, *args, **kwargs))
@@ -0,0 +1,68 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from config import Config
+from .metrics import track_call
+from .tracing import span, submit_in_context
+from .utils import log_execution_time
+from services.logger import logger
+
+# Keep-alive session so siteverify calls reuse the TLS connection to hcaptcha.com
+_session = requests.Session()
+_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=Config.HTTP_POOL_SIZE))
+_executor = ThreadPoolExecutor(max_workers=Config.HTTP_POOL_SIZE, thread_name_prefix='captcha')
+
+# sha256(token) -> time first seen. hCaptcha tokens are single use, so a token we've
+# already checked is rejected locally without another round trip.
+_seen_tokens = OrderedDict()
+_seen_tokens_lock = threading.Lock()
+MAX_SEEN_TOKENS = 10000
+
+def _claim_token(token):
+    """Record a token as used, returns False if it was already used within the replay window"""
+    digest = hashlib.sha256(token.encode()).hexdigest()
+    now = time.monotonic()
+    with _seen_tokens_lock:
+        # entries are in insertion order, so expired ones are at the front
+        while _seen_tokens:
+            oldest, seen_at = next(iter(_seen_tokens.items()))
+            if now - seen_at < Config.CAPTCHA_REPLAY_WINDOW and len(_seen_tokens) < MAX_SEEN_TOKENS:
+                break
+            _seen_tokens.popitem(last=False)
+        if digest in _seen_tokens:
+            return False
+        _seen_tokens[digest] = now
+        return True
+
+@log_execution_time
+def verify_hcaptcha(token):
+    """Verify hCAPTCHA token"""
+    logger.info("validating hcaptcha")
+    if not _claim_token(token):
+        logger.warning("captcha token reused")
+        return False
+    try:
+        with span('captcha'), track_call('hcaptcha', 'siteverify'):
+            response = _session.post(
+                Config.HCAPTCHA_VERIFY_URL,
+                data={
+                    'secret': Config.HCAPTCHA_SECRET_KEY,
+                    'response': token
+                },
+                timeout=5
+            )
+            result = response.json()
+        return result.get('success', False)
+    except Exception as e:
+        logger.error("Error Occurred", extra={'error verifying hCAPTCHA':str(e)}, exc_info=True)
+        # print(f"Error verifying hCAPTCHA: {e}")
+        return False
+
+def start_hcaptcha_verification(token):
+    """Verify a token in the background, returns a Future resolving to True/False"""
+    return submit_in_context(_executor, verify_hcaptcha, token)
@@ -0,0 +1,165 @@
+from datetime import datetime
+
+from config import Config
+from .validation import MAX_NAME_LENGTH, MAX_COMMENTS_LENGTH, VALID_HST_OPTIONS, \
+        text_field, email_field, decimal_field, choice_field, compile_schema, format_errors
+
+# Registry of the form types the backend accepts. Everything that differs between forms
+# (sheet columns, ID format, validation schema, notifications, settings) is described once
+# here, and the row encoder, ID formatter and validator for each form are built at import.
+# Adding a form means adding a FormDefinition below and a route for it.
+
+########### ID formats ####################
+
+class YearSequenceID:
+    """IDs like 20250042: the year followed by a 4-digit sequence that restarts each year"""
+    def formula(self, previous):
+        """Sheet formula computing the ID after the cell `previous`"""
+        current_year = datetime.now().year
+        return (f'=IF(INT({previous}/10000)<{current_year},'
+                f'{current_year * 10000 + 1},{previous}+1)')
+
+    def parse(self, value):
+        """Normalise a computed ID cell, None if the sheet produced an error"""
+        try:
+            return int(value)
+        except (ValueError, TypeError):
+            return None
+
+class PrefixedID:
+    """IDs like PA0042: a fixed prefix followed by a zero-padded counter"""
+    def __init__(self, prefix, width=4):
+        self.prefix = prefix
+        self._start = len(prefix)
+        self._formula = f'="{prefix}"&TEXT(VALUE(MID({{previous}},{len(prefix) + 1},10))+1,"{"0" * width}")'
+
+    def formula(self, previous):
+        return self._formula.format(previous=previous)
+
+    def parse(self, value):
+        if isinstance(value, str) and value.startswith(self.prefix) and value[self._start:].isdigit():
+            return value
+        return None
+
+########### Row encoding ####################
+
+EXPENSE = 'expense:'    # column prefix for a field of the expense line
+TIMESTAMP = 'timestamp'
+FILE = 'file'           # the receipt link for the row
+
+def compile_row_encoder(columns):
+    """
+    Build encode(timestamp, data, expenses, file_links) -> one sheet row per expense.
+    Columns are submission fields (e.g. 'email'), 'expense:<field>', 'timestamp' or 'file'.
+    """
+    width = len(columns)
+    timestamp_slot = columns.index(TIMESTAMP)
+    file_slot = columns.index(FILE)
+    expense_slots = tuple((i, column[len(EXPENSE):]) for i, column in enumerate(columns)
+                          if column.startswith(EXPENSE))
+    submission_slots = tuple((i, column) for i, column in enumerate(columns)
+                             if column not in (TIMESTAMP, FILE) and not column.startswith(EXPENSE))
+
+    def encode(timestamp, data, expenses, file_links):
+        # columns that are the same on every row are filled in once and copied
+        base = [None] * width
+        for slot, key in submission_slots:
+            base[slot] = data.get(key, '')
+        base[timestamp_slot] = timestamp
+
+        link_count = len(file_links)
+        rows = []
+        for i, expense in enumerate(expenses):
+            row = base.copy()
+            get = expense.get
+            for slot, key in expense_slots:
+                row[slot] = get(key, '')
+            # one receipt link per expense row, so file links work in google sheets
+            row[file_slot] = file_links[i] if i < link_count else '-'
+            rows.append(row)
+        return rows
+    return encode
+
+########### Form definitions ####################
+
+class FormDefinition:
+    def __init__(self, name, env_prefix, columns, id_format, fields, expense_fields,
+                 notifications, message):
+        self.name = name
+        self.env_prefix = env_prefix
+        self.columns = tuple(columns)
+        self.id_format = id_format
+        self.notifications = tuple(notifications)     # 'slack' and/or 'email'
+        self.message = message                        # shown in the acknowledgment email
+
+        self.sheet_id = Config.form_setting(env_prefix, 'SHEET_ID')
+        self.worksheet_name = Config.form_setting(env_prefix, 'WORKSHEET_NAME')
+        self.drive_folder_id = Config.form_setting(env_prefix, 'GOOGLE_DRIVE_FOLDER_ID')
+        self.recipient_email = Config.form_setting(env_prefix, 'RECIPIENT_EMAIL')
+
+        self.encode_rows = compile_row_encoder(self.columns)
+        self.validator = compile_schema(tuple(fields), tuple(expense_fields))
+
+    def notifies(self, kind):
+        return kind in self.notifications
+
+_CONTACT_FIELDS = (
+    ('firstName', text_field('First name', MAX_NAME_LENGTH)),
+    ('lastName', text_field('Last name', MAX_NAME_LENGTH)),
+    ('email', email_field('Invalid email address')),
+    ('comments', text_field('Comments', MAX_COMMENTS_LENGTH, required=False)),
+)
+_EXPENSE_FIELDS = (
+    ('vendor', text_field('Vendor (expense {i})')),
+    ('description', text_field('Description (expense {i})')),
+    ('amount', decimal_field('Amount (expense {i})')),
+)
+
+FORMS = {form.name: form for form in (
+    FormDefinition(
+        name="Reimbursement Request",
+        env_prefix='RR',
+        columns=('id', TIMESTAMP, 'firstName', 'lastName', 'email',
+                 'expense:approval', 'expense:vendor', 'expense:description', 'expense:amount', 'expense:hst',
+                 FILE, 'comments'),
+        id_format=YearSequenceID(),
+        fields=_CONTACT_FIELDS,
+        expense_fields=_EXPENSE_FIELDS + (
+            ('approval', text_field('Approval/Project (expense {i})')),
+            ('hst', choice_field(VALID_HST_OPTIONS, 'Invalid HST value (expense {i})')),
+        ),
+        notifications=('email',),       # no Slack channel for RR currently
+        message="Thank you for submitting your request! Our Treasurer will be in touch if there are any issues."
+    ),
+    FormDefinition(
+        name="Purchase Approval",
+        env_prefix='PA',
+        columns=('id', TIMESTAMP, 'firstName', 'lastName', 'email',
+                 'expense:vendor', 'expense:description', 'expense:amount',
+                 FILE, 'comments'),
+        id_format=PrefixedID('PA'),
+        fields=_CONTACT_FIELDS,
+        expense_fields=_EXPENSE_FIELDS,
+        notifications=('slack', 'email'),
+        message="Thank you for submitting your purchase approval request! Remember to keep an eye on the member's list for questions and +1s from the Board."
+    ),
+)}
+
+def get_form(endpoint):
+    """Definition for a form name, None if there is no such form"""
+    return FORMS.get(endpoint)
+
+def validate_form_data(endpoint, data):
+    """
+    Validate and sanitize all form data
+    Returns: (success: bool, error_message: str, sanitized_data: dict)
+    The error message lists every problem found, separated by '; '
+    """
+    form = FORMS.get(endpoint)
+    if form is None:
+        return False, f"Unknown form: {endpoint}", None
+
+    errors, sanitized = form.validator(data)
+    if errors:
+        return False, format_errors(errors), None
+    return True, "", sanitized
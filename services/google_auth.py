@@ -1,22 +1,118 @@
 import os
 import json
+import threading
+from datetime import datetime, timezone
 
+import requests
+from google.auth.transport.requests import Request
 from google.oauth2 import service_account
 
-def get_credentials(delegate_to=None):
-    SCOPES = ['https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive.file']
+from config import Config
+from services.logger import logger
+from .metrics import REGISTRY, stats_collector, track_call
 
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets',
+        'https://www.googleapis.com/auth/drive.file']
+
+# Credentials objects hold their own access token, so handing every caller the same
+# object per (scopes, delegate) shares the token too. A background thread refreshes
+# tokens before they expire, so request threads never have to mint one themselves.
+_base_credentials = None
+_credentials_cache = {}
+_credentials_lock = threading.Lock()
+_token_stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_failures': 0}
+
+_refresher = None
+_refresher_wakeup = threading.Event()
+_token_request = Request(session=requests.Session())
+
+# how often the refresher looks at tokens when none are close to expiring
+REFRESH_CHECK_INTERVAL = 300
+REFRESH_RETRY_INTERVAL = 30
+
+def get_delegate():
+    """Account that Drive and Sheets calls are made on behalf of"""
+    return Config.OUTBOUND_EMAIL_ADDRESS if Config.FLASK_ENV == 'production' else Config.DEV_OUTBOUND_EMAIL_ADDRESS
+
+def _load_credentials():
     creds_json = os.environ.get('GOOGLE_SHEETS_CREDENTIALS')
     if creds_json:
         creds_dict = json.loads(creds_json)
-        credentials = service_account.Credentials.from_service_account_file(creds_dict, scopes=SCOPES)
-    else:
-        credentials = service_account.Credentials.from_service_account_file('credentials.json', scopes=SCOPES)
+        return service_account.Credentials.from_service_account_info(creds_dict, scopes=SCOPES)
+    return service_account.Credentials.from_service_account_file('credentials.json', scopes=SCOPES)
+
+def _seconds_until_expiry(credentials):
+    if not credentials.token or not credentials.expiry:
+        return 0
+    now = datetime.now(timezone.utc).replace(tzinfo=None)    # google-auth uses naive UTC
+    return (credentials.expiry - now).total_seconds()
+
+def _refresh(credentials):
+    try:
+        with track_call('oauth', 'token'):
+            credentials.refresh(_token_request)
+        with _credentials_lock:
+            _token_stats['refreshes'] += 1
+        return True
+    except Exception as e:
+        with _credentials_lock:
+            _token_stats['refresh_failures'] += 1
+        logger.error("Error Occurred", extra={'error refreshing google access token':str(e)}, exc_info=True)
+        return False
+
+def _refresher_loop():
+    while True:
+        with _credentials_lock:
+            cached = list(_credentials_cache.values())
+
+        wait = REFRESH_CHECK_INTERVAL
+        for credentials in cached:
+            due_in = _seconds_until_expiry(credentials) - Config.TOKEN_REFRESH_MARGIN
+            if due_in <= 0:
+                due_in = REFRESH_CHECK_INTERVAL if _refresh(credentials) else REFRESH_RETRY_INTERVAL
+            wait = min(wait, due_in)
+
+        _refresher_wakeup.wait(wait)
+        _refresher_wakeup.clear()
+
+def _ensure_refresher():
+    global _refresher
+    with _credentials_lock:
+        if _refresher is None:
+            _refresher = threading.Thread(target=_refresher_loop, name='token-refresher', daemon=True)
+            _refresher.start()
+
+def get_credentials(delegate_to=None, scopes=SCOPES):
+    """Return shared credentials for (scopes, delegate) holding a valid access token"""
+    global _base_credentials
+    key = (tuple(scopes), delegate_to)
+    with _credentials_lock:
+        credentials = _credentials_cache.get(key)
+        if credentials is None:
+            if _base_credentials is None:
+                _base_credentials = _load_credentials()
+            credentials = _base_credentials
+            if list(scopes) != SCOPES:
+                credentials = credentials.with_scopes(list(scopes))
+            # Add delegation if specified
+            if delegate_to:
+                credentials = credentials.with_subject(delegate_to)
+            _credentials_cache[key] = credentials
+
+        fresh = _seconds_until_expiry(credentials) > Config.TOKEN_REFRESH_MARGIN
+        _token_stats['hits' if fresh else 'misses'] += 1
+
+    if not fresh:
+        # first use, or the refresher fell behind; mint inline and let the refresher reschedule
+        _refresh(credentials)
+        _refresher_wakeup.set()
+    _ensure_refresher()
+    return credentials
 
-    # Add delegation if specified
-    if delegate_to:
-        delegated_credentials = credentials.with_subject(delegate_to)
-        return delegated_credentials
+def get_token_cache_stats():
+    with _credentials_lock:
+        return dict(_token_stats, cached_credentials=len(_credentials_cache))
 
-    return credentials
\ No newline at end of file
+REGISTRY.register_collector(stats_collector(
+    'form_backend_token_cache', 'Google access token cache', get_token_cache_stats,
+    counters=('hits', 'misses', 'refreshes', 'refresh_failures')))
@@ -1,33 +1,213 @@
+import hashlib
 import os
 import json
-import io
-from googleapiclient.discovery import build
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from googleapiclient.http import MediaIoBaseUpload
 
 from config import Config
-from .google_auth import get_credentials
+from .google_transport import get_drive_http, get_drive_service
+from .local_store import connect
+from .metrics import REGISTRY, ROLLBACK_DELETES, RECEIPT_DEDUP, RECEIPT_DEDUP_BYTES, record_failure, \
+        stats_collector, track_call
+from .tracing import span, submit_in_context
 from .utils import log_execution_time
 from services.logger import logger
 
-_folder_cache = {}
+class FolderCache:
+    """
+    Bounded LRU cache of submission folder IDs with a TTL. If path is set, entries are also
+    kept in a local SQLite file so every worker on the host sees folders the others created.
+    """
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS folder_cache (
+        cache_key TEXT PRIMARY KEY,
+        folder_id TEXT NOT NULL,
+        stored_at REAL NOT NULL
+    );
+    """
+
+    def __init__(self, max_size, ttl, path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.stats = {'hits': 0, 'misses': 0}
+        self._entries = OrderedDict()       # cache_key -> (folder_id, stored_at)
+        self._lock = threading.Lock()
+
+    def _remember(self, key, folder_id, stored_at):
+        with self._lock:
+            self._entries[key] = (folder_id, stored_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            self._entries.pop(key, None)
+
+        if self.path:
+            row = connect(self.path, self._SCHEMA).execute(
+                "SELECT folder_id, stored_at FROM folder_cache WHERE cache_key = ? AND stored_at > ?",
+                (key, now - self.ttl)
+            ).fetchone()
+            if row:
+                self._remember(key, row['folder_id'], row['stored_at'])
+                with self._lock:
+                    self.stats['hits'] += 1
+                return row['folder_id']
+
+        with self._lock:
+            self.stats['misses'] += 1
+        return None
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, size=len(self._entries))
+
+    def put(self, key, folder_id):
+        now = time.time()
+        self._remember(key, folder_id, now)
+        if self.path:
+            conn = connect(self.path, self._SCHEMA)
+            conn.execute("INSERT OR REPLACE INTO folder_cache (cache_key, folder_id, stored_at) VALUES (?, ?, ?)",
+                         (key, folder_id, now))
+            conn.execute("DELETE FROM folder_cache WHERE stored_at <= ?", (now - self.ttl,))
+
+_folder_cache = FolderCache(Config.DRIVE_FOLDER_CACHE_SIZE, Config.DRIVE_FOLDER_CACHE_TTL,
+                            Config.DRIVE_FOLDER_CACHE_PATH or None)
+
+class ReceiptIndex:
+    """
+    Bounded LRU index from a receipt's SHA-256 to the Drive file it was uploaded as, for
+    DRIVE_DEDUP_WINDOW seconds. Sizes are indexed too, so a receipt only needs hashing before
+    upload when one of the same size is known. If path is set it is also kept in a local
+    SQLite file, so every worker on the host can link to receipts the others uploaded.
+    """
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS receipt_index (
+        sha256 TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        link TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        stored_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS receipt_index_size ON receipt_index (size, stored_at);
+    """
+
+    def __init__(self, max_size, ttl, path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()       # sha256 -> (file_id, link, size, stored_at)
+        self._sizes = Counter()             # size -> entries of that size
+        self._lock = threading.Lock()
+
+    def _drop(self, digest):
+        # caller holds the lock
+        entry = self._entries.pop(digest, None)
+        if entry:
+            self._sizes[entry[2]] -= 1
+            if not self._sizes[entry[2]]:
+                del self._sizes[entry[2]]
+
+    def _remember(self, digest, file_id, link, size, stored_at):
+        with self._lock:
+            self._drop(digest)
+            self._entries[digest] = (file_id, link, size, stored_at)
+            self._sizes[size] += 1
+            while len(self._entries) > self.max_size:
+                self._drop(next(iter(self._entries)))
+
+    def has_size(self, size):
+        """Whether a receipt of this size may be indexed (expired entries can still count)"""
+        with self._lock:
+            if size in self._sizes:
+                return True
+        if self.path:
+            return connect(self.path, self._SCHEMA).execute(
+                "SELECT 1 FROM receipt_index WHERE size = ? AND stored_at > ? LIMIT 1",
+                (size, time.time() - self.ttl)
+            ).fetchone() is not None
+        return False
+
+    def get(self, digest):
+        """(file_id, link) of an identical receipt uploaded within the window, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry and now - entry[3] < self.ttl:
+                self._entries.move_to_end(digest)
+                return entry[0], entry[1]
+            self._drop(digest)
+
+        if self.path:
+            row = connect(self.path, self._SCHEMA).execute(
+                "SELECT file_id, link, size, stored_at FROM receipt_index WHERE sha256 = ? AND stored_at > ?",
+                (digest, now - self.ttl)
+            ).fetchone()
+            if row:
+                self._remember(digest, row['file_id'], row['link'], row['size'], row['stored_at'])
+                return row['file_id'], row['link']
+        return None
+
+    def put(self, digest, file_id, link, size):
+        now = time.time()
+        self._remember(digest, file_id, link, size, now)
+        if self.path:
+            conn = connect(self.path, self._SCHEMA)
+            conn.execute("INSERT OR REPLACE INTO receipt_index (sha256, file_id, link, size, stored_at) "
+                         "VALUES (?, ?, ?, ?, ?)", (digest, file_id, link, size, now))
+            conn.execute("DELETE FROM receipt_index WHERE stored_at <= ?", (now - self.ttl,))
+
+    def forget(self, digest):
+        with self._lock:
+            self._drop(digest)
+        if self.path:
+            connect(self.path, self._SCHEMA).execute("DELETE FROM receipt_index WHERE sha256 = ?", (digest,))
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+_receipt_index = ReceiptIndex(Config.DRIVE_DEDUP_INDEX_SIZE, Config.DRIVE_DEDUP_WINDOW,
+                              Config.DRIVE_DEDUP_INDEX_PATH or None)
+
+# Drive accepts at most 100 calls per batch request
+DRIVE_BATCH_LIMIT = 100
+
+# Drive requires resumable upload chunks to be a multiple of 256 KiB
+UPLOAD_CHUNK_UNIT = 256 * 1024
+
+# bytes read at a time when hashing a receipt
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Shared across requests so worker threads (and their keep-alive Drive connections) are reused
+_upload_executor = ThreadPoolExecutor(max_workers=Config.DRIVE_UPLOAD_CONCURRENCY,
+                                      thread_name_prefix='drive-upload')
 
 @log_execution_time
 def delete_from_google_drive(file_id):
     try:
-        delegate = Config.OUTBOUND_EMAIL_ADDRESS if Config.FLASK_ENV == 'production' else Config.DEV_OUTBOUND_EMAIL_ADDRESS #todo: refactor, move this inside get_credentials?
-        credentials = get_credentials(delegate_to=delegate)
-        
-        # Build Drive API service
-        service = build('drive', 'v3', credentials=credentials)
+        service = get_drive_service()
 
         # Use Shared Drive
         supports_all_drives = {'supportsAllDrives': True}
 
         # Delete the file
-        service.files().delete(
-            fileId=file_id,
-            supportsAllDrives=True
-        ).execute()
+        with track_call('drive', 'delete'):
+            service.files().delete(
+                fileId=file_id,
+                supportsAllDrives=True
+            ).execute(http=get_drive_http())
         
         return True
         
@@ -36,68 +216,206 @@ def delete_from_google_drive(file_id):
         logger.error("Error Occurred", extra={'error deleting file from google drive':str(e)}, exc_info=True)
         return False
 
+def execute_drive_batch(drive_requests):
+    """
+    Run independent Drive requests as batch HTTP calls (up to DRIVE_BATCH_LIMIT per call).
+    drive_requests: list of requests built from get_drive_service(), not yet executed
+    Returns: list of (response, exception) in the same order; exception is None on success
+    """
+    service = get_drive_service()
+    http = get_drive_http()
+    results = [(None, None)] * len(drive_requests)
+
+    def callback(request_id, response, exception):
+        results[int(request_id)] = (response, exception)
+
+    for offset in range(0, len(drive_requests), DRIVE_BATCH_LIMIT):
+        batch = service.new_batch_http_request(callback=callback)
+        for i, drive_request in enumerate(drive_requests[offset:offset + DRIVE_BATCH_LIMIT], offset):
+            batch.add(drive_request, request_id=str(i))
+        with track_call('drive', 'batch'):
+            batch.execute(http=http)
+
+    return results
+
 @log_execution_time
-def upload_to_google_drive(file_data, filename, request_id, parent_folder_id=None):
-    """Upload file to Google Drive in a request-specific subfolder and return shareable link"""
+def batch_delete_from_google_drive(file_ids):
+    """
+    Delete several files in one round trip (per 100 files)
+    Returns: {'deleted': [file ids], 'failed': {file id: error message}}
+    """
+    report = {'deleted': [], 'failed': {}}
+    # a receipt attached to several expenses appears once per expense but is stored once
+    file_ids = list(dict.fromkeys(file_ids))
+    if not file_ids:
+        return report
+
     try:
-        delegate = Config.OUTBOUND_EMAIL_ADDRESS if Config.FLASK_ENV == 'production' else Config.DEV_OUTBOUND_EMAIL_ADDRESS
-        credentials = get_credentials(delegate_to=delegate)
-        service = build('drive', 'v3', credentials=credentials)
-        supports_all_drives = {'supportsAllDrives': True}
+        service = get_drive_service()
+        results = execute_drive_batch([
+            service.files().delete(fileId=file_id, supportsAllDrives=True) for file_id in file_ids
+        ])
+        for file_id, (_, exception) in zip(file_ids, results):
+            if exception is None:
+                report['deleted'].append(file_id)
+            else:
+                report['failed'][file_id] = str(exception)
+                record_failure('drive', 'delete')
+    except Exception as e:
+        logger.error("Error Occurred", extra={'error batch deleting from google drive':str(e)}, exc_info=True)
+        for file_id in file_ids:
+            if file_id not in report['deleted']:
+                report['failed'][file_id] = str(e)
+
+    ROLLBACK_DELETES.inc(len(report['deleted']), result='deleted')
+    ROLLBACK_DELETES.inc(len(report['failed']), result='failed')
+    if report['failed']:
+        logger.error("failed to delete some files from google drive", extra={'failed_deletes': report['failed']})
+    return report
+
+def build_media_upload(file_data, stream=None):
+    """
+    Resumable upload that reads straight from the uploaded file's stream, one chunk at a time.
+    Werkzeug already spools large request files to a temp file, so nothing else is copied.
+    stream: read from this instead of the file's own stream (e.g. a HashingReader around it)
+    """
+    chunksize = max(1, Config.DRIVE_UPLOAD_CHUNK_SIZE // UPLOAD_CHUNK_UNIT) * UPLOAD_CHUNK_UNIT
+    stream = stream or getattr(file_data, 'stream', file_data)
+    stream.seek(0)
+    return MediaIoBaseUpload(
+        stream,
+        mimetype=file_data.content_type or 'application/octet-stream',
+        chunksize=chunksize,
+        resumable=True
+    )
+
+class HashingReader:
+    """
+    Stream wrapper that computes the SHA-256 of the bytes read through it, so a receipt is
+    hashed by the upload's own reads. Bytes read again (a resumed chunk) are only hashed once.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._digest = hashlib.sha256()
+        self.hashed = 0     # bytes hashed so far, always a prefix of the file
+
+    def read(self, n=-1):
+        start = self._stream.tell()
+        data = self._stream.read(n)
+        if start <= self.hashed < start + len(data):
+            self._digest.update(data[self.hashed - start:])
+            self.hashed = start + len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._stream.seek(offset, whence)
+
+    def tell(self):
+        return self._stream.tell()
+
+    def hexdigest(self, size):
+        """SHA-256 of the file, or None if it wasn't read through to its size"""
+        return self._digest.hexdigest() if self.hashed == size else None
+
+def file_size(file_data):
+    stream = getattr(file_data, 'stream', file_data)
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def hash_file(file_data):
+    """SHA-256 of an uploaded file, read from its stream a chunk at a time"""
+    stream = getattr(file_data, 'stream', file_data)
+    stream.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def get_submission_folder(request_id, parent_folder_id=None, fresh_id=False):
+    """
+    Find or create the request-specific subfolder, returns its ID.
+    fresh_id: the ID was just reserved, so no folder can exist yet and the lookup is skipped
+    """
+    service = get_drive_service()
+    http = get_drive_http()
+    supports_all_drives = {'supportsAllDrives': True}
+
+    cache_key = f"{parent_folder_id}_{request_id}"
+    folder_id = _folder_cache.get(cache_key)
+    if folder_id is None:
+        # Create or find folder (existing logic)
+        folder_metadata = {
+            'name': request_id,
+            'mimeType': 'application/vnd.google-apps.folder'
+        }
         
-        cache_key = f"{parent_folder_id}_{request_id}"
-        if cache_key in _folder_cache:
-            folder_id = _folder_cache[cache_key]
-        else:
-            # Create or find folder (existing logic)
-            folder_metadata = {
-                'name': request_id,
-                'mimeType': 'application/vnd.google-apps.folder'
-            }
-            
-            if parent_folder_id:
-                folder_metadata['parents'] = [parent_folder_id]
-            
+        if parent_folder_id:
+            folder_metadata['parents'] = [parent_folder_id]
+        
+        folders = []
+        if not fresh_id:
             query = f"name='{request_id}' and mimeType='application/vnd.google-apps.folder' and trashed=false"
             if parent_folder_id:
                 query += f" and '{parent_folder_id}' in parents"
             
-            results = service.files().list(
-                q=query, 
-                fields='files(id)',
-                **supports_all_drives,
-                includeItemsFromAllDrives=True
-            ).execute()
+            with track_call('drive', 'list'):
+                results = service.files().list(
+                    q=query, 
+                    fields='files(id)',
+                    **supports_all_drives,
+                    includeItemsFromAllDrives=True
+                ).execute(http=http)
             folders = results.get('files', [])
-            
-            if folders:
-                folder_id = folders[0]['id']
-            else:
+        
+        if folders:
+            folder_id = folders[0]['id']
+        else:
+            with track_call('drive', 'create_folder'):
                 folder = service.files().create(
                     body=folder_metadata, 
                     fields='id',
                     **supports_all_drives
-                ).execute()
-                folder_id = folder.get('id')
-                
-                # Make folder accessible to organisation members
-                """permission = {
-                    'type': 'domain',
-                    'role': 'reader',
-                    'domain': Config.ORGANIZATION_DOMAIN
-                }
-                try:
-                    service.permissions().create(
-                        fileId=folder_id,
-                        body=permission,
-                        **supports_all_drives
-                    ).execute()
-                except Exception as e:
-                    print(f"Error editing folder permissions: {e}")"""
-            
-            # Cache the folder ID
-            _folder_cache[cache_key] = folder_id
+                ).execute(http=http)
+            folder_id = folder.get('id')
             
+            # Make folder accessible to organisation members
+            """permission = {
+                'type': 'domain',
+                'role': 'reader',
+                'domain': Config.ORGANIZATION_DOMAIN
+            }
+            try:
+                service.permissions().create(
+                    fileId=folder_id,
+                    body=permission,
+                    **supports_all_drives
+                ).execute()
+            except Exception as e:
+                print(f"Error editing folder permissions: {e}")"""
+        
+        # Cache the folder ID
+        _folder_cache.put(cache_key, folder_id)
+
+    return folder_id
+
+@log_execution_time
+def upload_to_google_drive(file_data, filename, request_id, parent_folder_id=None, cancel_event=None, stream=None):
+    """
+    Upload file to Google Drive in a request-specific subfolder and return shareable link.
+    If cancel_event is set part way through, the upload is abandoned between chunks.
+    stream: read the file from this wrapper around its stream, see build_media_upload
+    Returns: (link, file_id), or (None, None) on failure/cancellation
+    """
+    try:
+        service = get_drive_service()
+        http = get_drive_http()
+        supports_all_drives = {'supportsAllDrives': True}
+        
+        folder_id = get_submission_folder(request_id, parent_folder_id)
+
         # Prepare file metadata (upload into the request folder)
         file_metadata = {
             'name': filename,
@@ -105,19 +423,22 @@ def upload_to_google_drive(file_data, filename, request_id, parent_folder_id=Non
         }
         
         # Create media upload
-        media = MediaIoBaseUpload(
-            io.BytesIO(file_data.read()),
-            mimetype=file_data.content_type or 'application/octet-stream',
-            resumable=True
-        )
+        media = build_media_upload(file_data, stream)
         
         # Upload file
-        file = service.files().create(
+        upload_request = service.files().create(
             body=file_metadata,
             media_body=media,
             fields='id, webViewLink',
                 **supports_all_drives
-        ).execute()
+        )
+        file = None
+        with span('upload', filename), track_call('drive', 'upload'):
+            while file is None:
+                if cancel_event is not None and cancel_event.is_set():
+                    logger.info("upload cancelled", extra={'filename': filename})
+                    return None, None
+                _, file = upload_request.next_chunk(http=http)
         
         # Make file accessible to organisation members
         """permission = {
@@ -139,4 +460,183 @@ def upload_to_google_drive(file_data, filename, request_id, parent_folder_id=Non
     except Exception as e:
         # print(f"Error uploading to Google Drive: {e}")
         logger.error("Error Occurred", extra={'error uploading to google drive':str(e)}, exc_info=True)
-        return None
\ No newline at end of file
+        return None, None
+
+def create_drive_shortcut(target_id, filename, folder_id):
+    """Shortcut to an existing Drive file in folder_id, returns the shortcut's file ID"""
+    service = get_drive_service()
+    with track_call('drive', 'create_shortcut'):
+        shortcut = service.files().create(
+            body={
+                'name': filename,
+                'mimeType': 'application/vnd.google-apps.shortcut',
+                'shortcutDetails': {'targetId': target_id},
+                'parents': [folder_id]
+            },
+            fields='id',
+            supportsAllDrives=True
+        ).execute(http=get_drive_http())
+    return shortcut.get('id')
+
+def _find_receipt(digest):
+    try:
+        return _receipt_index.get(digest)
+    except Exception as e:
+        # the index only saves uploads, never fail one because of it
+        logger.error("Error Occurred", extra={'error reading receipt index':str(e)}, exc_info=True)
+        return None
+
+def _has_receipt_size(size):
+    try:
+        return _receipt_index.has_size(size)
+    except Exception as e:
+        logger.error("Error Occurred", extra={'error reading receipt index':str(e)}, exc_info=True)
+        return False
+
+def store_receipt(file_data, filename, digest, size, request_id, parent_folder_id=None, cancel_event=None):
+    """
+    Put one receipt in the request's folder. If an identical file was uploaded within
+    DRIVE_DEDUP_WINDOW, a shortcut to it is created instead of uploading again.
+    digest: the file's SHA-256 if it was hashed up front, otherwise it is hashed as it uploads
+    Uploaded receipts are indexed straight away, so concurrent submissions can link to them
+    too; rollback_receipts takes them out of the index again.
+    Returns: {'fid', 'link', 'sha256'} ('shortcut_to' set for shortcuts, 'indexed' once
+    indexed), or None on failure
+    """
+    dedup = Config.DRIVE_DEDUP_WINDOW > 0
+    original = _find_receipt(digest) if dedup and digest else None
+    if original:
+        target_id, link = original
+        try:
+            folder_id = get_submission_folder(request_id, parent_folder_id)
+            with span('upload', f"{filename} (shortcut)"):
+                shortcut_id = create_drive_shortcut(target_id, filename, folder_id)
+            RECEIPT_DEDUP.inc(source='earlier_submission')
+            RECEIPT_DEDUP_BYTES.inc(size)
+            # the sheet links the original; the shortcut is this submission's own file, so a
+            # rollback deletes the shortcut and never the shared original
+            return {'fid': shortcut_id, 'link': link, 'sha256': digest, 'shortcut_to': target_id}
+        except Exception as e:
+            # most likely the original was deleted, so stop pointing at it and upload a fresh copy
+            logger.warning("receipt shortcut failed, uploading instead", extra={'filename': filename, 'error': str(e)})
+            _receipt_index.forget(digest)
+
+    reader = None
+    if dedup and not digest:
+        reader = HashingReader(getattr(file_data, 'stream', file_data))
+    link, fid = upload_to_google_drive(file_data, filename, request_id, parent_folder_id, cancel_event, reader)
+    if not link:
+        return None
+    if reader:
+        digest = reader.hexdigest(size)
+    file = {'fid': fid, 'link': link, 'sha256': digest}
+
+    if dedup and digest:
+        try:
+            _receipt_index.put(digest, fid, link, size)
+            file['indexed'] = True
+        except Exception as e:
+            logger.error("Error Occurred", extra={'error indexing uploaded receipt':str(e)}, exc_info=True)
+    return file
+
+def rollback_receipts(uploaded):
+    """
+    Delete a failed submission's files (store_receipt results) from Drive: its uploads and
+    shortcuts, never the originals the shortcuts point to. Uploads are dropped from the
+    receipt index first, so later submissions don't link to a file that is being deleted.
+    Returns: batch_delete_from_google_drive's report
+    """
+    files = [file for file in uploaded if file]
+    for file in files:
+        if file.get('indexed'):
+            try:
+                _receipt_index.forget(file['sha256'])
+            except Exception as e:
+                logger.error("Error Occurred", extra={'error removing receipt from index':str(e)}, exc_info=True)
+    return batch_delete_from_google_drive([file['fid'] for file in files])
+
+@log_execution_time
+def upload_files_to_google_drive(files, request_id, parent_folder_id=None, fresh_id=False):
+    """
+    Upload several files concurrently into the request's folder.
+    files: list of (file_data, filename). As soon as one upload fails, queued uploads are
+    cancelled, in-flight ones stop at their next chunk and completed ones are deleted.
+    fresh_id: request_id was just reserved, so its folder is created without looking it up first
+    Returns: (list of {'fid', 'link'} in the same order as files, list of errors)
+    """
+    if not files:
+        return [], []
+
+    try:
+        # Create the folder once up front so parallel uploads don't race to create it
+        with span('drive_folder'):
+            get_submission_folder(request_id, parent_folder_id, fresh_id=fresh_id)
+    except Exception as e:
+        logger.error("Error Occurred", extra={'error creating google drive folder':str(e)}, exc_info=True)
+        return [], ["Failed to create upload folder"]
+
+    # Identical receipts (the same PDF attached to several expenses, or one uploaded before)
+    # are stored once. Only files that could be duplicates, by size, are hashed up front; the
+    # rest are hashed by their upload's own reads
+    sizes = [file_size(file_data) for file_data, _ in files]
+    size_counts = Counter(sizes)
+    digests = [None] * len(files)
+    if Config.DRIVE_DEDUP_WINDOW > 0:
+        with span('hash_receipts'):
+            for i, (file_data, _) in enumerate(files):
+                if size_counts[sizes[i]] > 1 or _has_receipt_size(sizes[i]):
+                    digests[i] = hash_file(file_data)
+    first_copy = {}     # sha256 (or the index, if not hashed) -> index of the first file with that content
+    for i, digest in enumerate(digests):
+        first_copy.setdefault(digest or i, i)
+
+    cancel_event = threading.Event()
+    uploaded = [None] * len(files)
+    errors = []
+
+    futures = {
+        submit_in_context(_upload_executor, store_receipt, files[i][0], files[i][1], digests[i], sizes[i],
+                          request_id, parent_folder_id, cancel_event): i
+        for i in first_copy.values()
+    }
+    for future in as_completed(futures):
+        i = futures[future]
+        if future.cancelled():
+            continue
+        try:
+            file = future.result()
+        except Exception as e:
+            logger.error("Error Occurred", extra={'error uploading file to google drive':str(e)}, exc_info=True)
+            file = None
+        if file:
+            uploaded[i] = file
+        elif not cancel_event.is_set():
+            errors.append(f"Failed to upload {files[i][1]}")
+            cancel_event.set()
+            for pending in futures:
+                pending.cancel()
+
+    if errors:
+        # Roll back whatever finished before (or despite) the cancellation
+        rollback_receipts(uploaded)
+        return [], errors
+
+    for i, digest in enumerate(digests):
+        if uploaded[i] is None:
+            uploaded[i] = uploaded[first_copy[digest or i]]
+            RECEIPT_DEDUP.inc(source='same_submission')
+            RECEIPT_DEDUP_BYTES.inc(sizes[i])
+
+    return uploaded, []
+
+def get_folder_cache_stats():
+    return _folder_cache.snapshot()
+
+def get_receipt_index_stats():
+    return {'size': _receipt_index.size()}
+
+REGISTRY.register_collector(stats_collector(
+    'form_backend_folder_cache', 'Drive submission folder cache', get_folder_cache_stats,
+    counters=('hits', 'misses')))
+REGISTRY.register_collector(stats_collector(
+    'form_backend_receipt_index', 'Receipt hashes indexed for deduplication', get_receipt_index_stats))
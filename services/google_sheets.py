@@ -1,187 +1,337 @@
 import math
+import re
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime
 import gspread
+from gspread.exceptions import APIError, SpreadsheetNotFound, WorksheetNotFound
+from gspread.utils import absolute_range_name, rowcol_to_a1
 
 from config import Config
-from .google_auth import get_credentials
+from .forms import FORMS
+from .google_auth import get_credentials, get_delegate
+from .google_transport import get_sheets_session
+from .metrics import REGISTRY, RETRIES, RESERVATION_VOIDS, stats_collector, track_call
 from .utils import log_execution_time
 from services.logger import logger
 
 _sheets_client = None
 
+# Placeholder rows are appended with an ID formula that is computed by the sheet
+# from the row directly above, so concurrent reservations always land on distinct
+# rows and therefore distinct IDs. The marker goes in the timestamp column until
+# the row is filled in (or voided if the submission fails).
+_PREVIOUS_ID = 'INDIRECT("R[-1]C",FALSE)'
+RESERVED_MARKER = 'PENDING'
+VOID_MARKER = 'VOID'
+_RANGE_ROWS = re.compile(r"!\$?[A-Z]+\$?(\d+)(?::\$?[A-Z]+\$?(\d+))?$")
+
+# endpoint -> (worksheet, cached_at). Saves the open_by_key + worksheet metadata calls
+_worksheet_cache = {}
+_worksheet_cache_lock = threading.Lock()
+_worksheet_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
 def setup_google_sheets():
     """Initialize Google Sheets API connection with caching"""
     global _sheets_client
-    delegate = Config.OUTBOUND_EMAIL_ADDRESS if Config.FLASK_ENV == 'production' else Config.DEV_OUTBOUND_EMAIL_ADDRESS
-    credentials = get_credentials(delegate_to=delegate)
     if _sheets_client is None:
-        delegate = Config.OUTBOUND_EMAIL_ADDRESS if Config.FLASK_ENV == 'production' else Config.DEV_OUTBOUND_EMAIL_ADDRESS
-        credentials = get_credentials(delegate_to=delegate)
-        _sheets_client = gspread.authorize(credentials)
+        delegate = get_delegate()
+        _sheets_client = gspread.Client(get_credentials(delegate_to=delegate),
+                                        session=get_sheets_session(delegate))
     return _sheets_client
 
 def get_worksheet(client, endpoint):
-    spreadsheet = client.open_by_key(Config.GOOGLE_SHEET_ID[endpoint])
-    logger.info("accessed spreadsheet")
-    sheet = spreadsheet.worksheet(Config.GOOGLE_WORKSHEET_NAME[endpoint]) 
-    logger.info("accessed worksheet")
+    """Return the worksheet for an endpoint, reusing a cached handle until it expires"""
+    with _worksheet_cache_lock:
+        entry = _worksheet_cache.get(endpoint)
+        if entry and time.monotonic() - entry[1] < Config.WORKSHEET_CACHE_TTL:
+            _worksheet_cache_stats['hits'] += 1
+            return entry[0]
+        _worksheet_cache_stats['misses'] += 1
 
+    with track_call('sheets', 'open'):
+        form = FORMS[endpoint]
+        spreadsheet = client.open_by_key(form.sheet_id)
+        logger.info("accessed spreadsheet")
+        sheet = spreadsheet.worksheet(form.worksheet_name)
+    logger.info("accessed worksheet", extra={'worksheet_cache': get_worksheet_cache_stats()})
+
+    with _worksheet_cache_lock:
+        _worksheet_cache[endpoint] = (sheet, time.monotonic())
     return sheet
 
-@log_execution_time
-def id_iterator(client, endpoint):
-    try:
-        sheet = get_worksheet(client, endpoint)
+def invalidate_worksheet(endpoint):
+    """Drop the cached worksheet handle for an endpoint"""
+    with _worksheet_cache_lock:
+        if _worksheet_cache.pop(endpoint, None):
+            _worksheet_cache_stats['invalidations'] += 1
+
+def get_worksheet_cache_stats():
+    with _worksheet_cache_lock:
+        return dict(_worksheet_cache_stats, size=len(_worksheet_cache))
+
+REGISTRY.register_collector(stats_collector(
+    'form_backend_worksheet_cache', 'Cached worksheet handles', get_worksheet_cache_stats,
+    counters=('hits', 'misses', 'invalidations')))
+
+def _invalidate_on_sheet_error(endpoint, error):
+    """Invalidate the cached handle when an error means it is stale (not found / no permission)"""
+    if isinstance(error, (WorksheetNotFound, SpreadsheetNotFound)) or \
+            (isinstance(error, APIError) and getattr(error, 'code', None) in (403, 404)):
+        logger.warning("invalidating cached worksheet", extra={'endpoint': endpoint, 'error': str(error)})
+        invalidate_worksheet(endpoint)
+
+class SheetWriteBatcher:
+    """
+    Group commit for sheet writes. Writes submitted by concurrent requests within `window`
+    seconds of each other are sent by a single writer thread as one values.batchUpdate call
+    per spreadsheet.
+    Each caller gets its own Future. If a combined call fails, its writes are retried one
+    by one so a bad write only fails its own request. No write waits in the buffer longer
+    than `window`, and a full batch (`max_batch`) is sent immediately.
+    """
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._cond = threading.Condition()
+        self._writer = None
+
+    def _submit(self, item):
+        item['future'] = Future()
+        item['queued_at'] = time.monotonic()
+        with self._cond:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name='sheet-writer', daemon=True)
+                self._writer.start()
+            self._pending.append(item)
+            self._cond.notify()
+        return item['future']
+
+    def update(self, sheet, range_name, values):
+        """Queue a write of values to range_name (A1, without sheet title), returns a Future"""
+        return self._submit({'sheet': sheet, 'range': absolute_range_name(sheet.title, range_name),
+                             'values': values})
+
+    def _take_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = self._pending[0]['queued_at'] + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        return batch
 
-        id_column = sheet.col_values(1)
+    def _run(self):
+        while True:
+            groups = {}
+            for item in self._take_batch():
+                groups.setdefault(item['sheet'].spreadsheet.id, []).append(item)
+            for items in groups.values():
+                self._commit(items)
 
-        if endpoint == "Reimbursement Request":
-            if not id_column or len(id_column) == 0:
-                return [0]
-            
-            lastId = id_column[-1]  # Last value in column
+    @staticmethod
+    def _send(items):
+        with track_call('sheets', 'batch_update'):
+            items[0]['sheet'].spreadsheet.values_batch_update(body={
+                'valueInputOption': 'USER_ENTERED',
+                'data': [{'range': item['range'], 'values': item['values']} for item in items]
+            })
+
+    def _commit(self, items):
+        try:
+            self._send(items)
+            for item in items:
+                item['future'].set_result(True)
+            return
+        except Exception as e:
+            if len(items) == 1:
+                items[0]['future'].set_exception(e)
+                return
+            logger.warning("group commit failed, retrying writes individually",
+                           extra={'batch_size': len(items), 'error': str(e)})
+            RETRIES.inc(len(items), component='sheets_group_commit')
+        for item in items:
             try:
-                lastId_num = int(lastId)
-                id_year = lastId_num // 10000
-                id_index = lastId_num % 10000
-                current_year = datetime.now().year
-                if id_year < current_year:
-                    return [1, ((current_year * 10000) + 1)]
-                else:
-                    return [1, (current_year * 10000) + id_index + 1]
-            except ValueError:
-                return [0]
-        elif endpoint == "Purchase Approval":
-            if not id_column or len(id_column) == 0:
-                return [0]
-            lastId = id_column[-1]
-            if lastId[:2] == "PA":      #valid format
-                try:
-                    lastId_num = int(lastId[2:])
-                    newId_num = lastId_num + 1
-                    return [1, f"PA{newId_num:04d}"]
-                except ValueError: # invalid integer after "PA"
-                    return [0]
-            else:
-                return [0]
-        else:       #invalid endpoint
-            # print(f"Invalid endoint")
-            logger.warning("Invalid Endpoint")
-            return [0]
-    except Exception as e:
-        # print(f"Error accessing google sheet: {e}")
-        logger.exception("Exception Occurred", extra={'failed to access google sheet':str(e)}, exc_info=True)
+                self._send([item])
+                item['future'].set_result(True)
+            except Exception as e:
+                item['future'].set_exception(e)
+
+_write_batcher = SheetWriteBatcher(Config.SHEETS_GROUP_COMMIT_WINDOW_MS / 1000, Config.SHEETS_GROUP_COMMIT_MAX_BATCH)
+
+def buildrow(timestamp, endpoint, data, expense, row_file_entry):
+    form = FORMS.get(endpoint)
+    if form is None:
+        logger.warning("invalid endpoint, returning empty row")
+        return []
+    return form.encode_rows(timestamp, data, (expense,), (row_file_entry,))[0]
+
+DUMMY_EXPENSE = {
+    'approval': '-',
+    'vendor': '-',
+    'description': '-',
+    'amount': '-',
+    'hst': '-'
+}
+
+def count_rows(data, file_count):
+    """Number of sheet rows build_rows produces: one per expense, plus one per extra file"""
+    return max(len(data['expenses']), file_count)
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def build_rows(endpoint, data, file_links, timestamp=None):
+    """
+    Build one sheet row per expense, plus extra rows for any leftover file links.
+    timestamp: when the submission was received (TIMESTAMP_FORMAT), defaults to now
+    """
+    if timestamp is None:
+        timestamp = datetime.now().strftime(TIMESTAMP_FORMAT)
+    form = FORMS[endpoint]
+
+    # Add each expense as a separate row
+    expenses = data['expenses']
+    rows = form.encode_rows(timestamp, data, expenses, file_links)
 
-        return [0]            #if accessing google sheet failed, abort attempt
+    #if there are more file links than expense rows, add extra lines
+    leftover_files = file_links[len(expenses):]
+    if leftover_files:
+        rows += form.encode_rows(timestamp, data, (DUMMY_EXPENSE,) * len(leftover_files), leftover_files)
 
-def is_id_unused(endpoint, id):     # returns -1 for collision, 0 for error, 1 for success
+    return rows
+
+@log_execution_time
+def reserve_id_in_google_sheet(endpoint, row_count=1):
+    """
+    Claim the next submission ID by appending placeholder rows to the sheet.
+    The first row's ID is a formula over the row above it (the rest copy the row above),
+    so two submissions can never be handed the same ID. The computed ID is then written
+    back as a plain value so later edits to the sheet can't shift it.
+    Returns: {'id', 'start_row', 'end_row'} or None on failure
+    """
+    logger.info("attempting to reserve id in google sheet")
     try:
+        form = FORMS.get(endpoint)
+        if form is None:
+            logger.warning("Invalid Endpoint")
+            return None
+        # Sheet formula that computes the next ID from the ID in the row above
+        formula = form.id_format.formula(_PREVIOUS_ID)
+
         client = setup_google_sheets()
         if not client:
-            # print(f"Error with google sheet authentication")
             logger.error("Error with google sheet authentication")
-            return 0
+            return None
         sheet = get_worksheet(client, endpoint)
-        id_column = sheet.col_values(1)
-        if str(id) in id_column:
-            return -1
-        else:
-            return 1
+
+        row_count = max(1, row_count)
+        reservation = None
+        placeholder = [[formula, RESERVED_MARKER]]
+        placeholder += [[f'={_PREVIOUS_ID}', RESERVED_MARKER] for _ in range(row_count - 1)]
+
+        with track_call('sheets', 'append'):
+            response = sheet.spreadsheet.values_append(
+                absolute_range_name(sheet.title, "A1"),
+                params={
+                    'valueInputOption': 'USER_ENTERED',
+                    'includeValuesInResponse': True,
+                    'responseValueRenderOption': 'UNFORMATTED_VALUE'
+                },
+                body={'values': placeholder}
+            )
+
+        updates = response['updates']
+        match = _RANGE_ROWS.search(updates['updatedRange'])
+        start_row = int(match.group(1))
+        end_row = int(match.group(2) or start_row)
+        values = updates.get('updatedData', {}).get('values', [])
+        new_id = form.id_format.parse(values[0][0] if values and values[0] else None)
+
+        if new_id is None:
+            # Previous row didn't hold a valid ID, nothing was claimed so just clear the rows
+            logger.error("reserved row produced an invalid id", extra={'range': updates['updatedRange']})
+            with track_call('sheets', 'clear'):
+                sheet.batch_clear([f"A{start_row}:B{end_row}"])
+            return None
+
+        reservation = {'id': new_id, 'start_row': start_row, 'end_row': end_row}
+
+        # Freeze the computed ID so it no longer depends on the row above
+        with track_call('sheets', 'update'):
+            sheet.update(
+                range_name=f"A{start_row}:A{end_row}",
+                values=[[new_id]] * (end_row - start_row + 1),
+                value_input_option='USER_ENTERED'
+            )
+        return reservation
     except Exception as e:
-        # print(f"Error accessing google sheet: {e}")
-        logger.exception("Exception Occurred", extra={'error accessing google sheet':str(e)}, exc_info=True)
-        return 0            #if accessing google sheet failed, abort attempt
+        _invalidate_on_sheet_error(endpoint, e)
+        logger.exception("Exception Occurred", extra={'error reserving id in google sheet':str(e)}, exc_info=True)
+        if reservation:
+            # The rows were appended but still hold the live formula. Void them, which also
+            # writes the ID as a plain value, so later reservations chain off a frozen row
+            release_reserved_id(endpoint, reservation)
+        return None
 
 @log_execution_time
-def get_next_id_from_google_sheet(endpoint):
-    logger.info("attempting to retrieve next id from google sheet")
+def fill_reserved_rows(endpoint, reservation, data, file_links, timestamp=None):
+    """Write a submission into the rows claimed by reserve_id_in_google_sheet"""
     try:
         client = setup_google_sheets()
-        if not client:
-            logger.error("Error with google sheet authentication")
-            # print(f"Error with google sheet authentication")
-            return 0
-        
-        newId = id_iterator(client, endpoint)
-        if newId[0] > 0:
-            return newId[1]
+        sheet = get_worksheet(client, endpoint)
+
+        rows = build_rows(endpoint, data, file_links, timestamp)
+        start_row, end_row = reservation['start_row'], reservation['end_row']
+        reserved = end_row - start_row + 1
+
+        if len(rows) > reserved:
+            # appending the extra rows would put this ID below rows reserved since
+            raise ValueError(f"submission needs {len(rows)} rows but only {reserved} were reserved")
+
+        in_place = rows
+        while len(in_place) < reserved:
+            # more rows were reserved than needed, keep the ID and fill the spare row with dashes
+            in_place.append(buildrow(in_place[0][1], endpoint, data, DUMMY_EXPENSE, '-'))
+
+        range_name = f"A{start_row}:{rowcol_to_a1(end_row, len(in_place[0]))}"
+        if Config.SHEETS_GROUP_COMMIT:
+            # coalesced with other submissions' writes, but we still wait for our own result
+            _write_batcher.update(sheet, range_name, in_place).result()
         else:
-            raise ValueError("invalid ID")
+            with track_call('sheets', 'update'):
+                sheet.update(range_name=range_name, values=in_place, value_input_option='USER_ENTERED')
+
+        return True
     except Exception as e:
-        logger.exception("Exception Occurred", extra={'error accessing google sheet':str(e)}, exc_info=True)
-        # print(f"Error accessing google sheet: {e}")
-        return 0            #if accessing google sheet failed, abort attempt
-    
-def buildrow(timestamp, endpoint, data, expense, row_file_entry):
-    if endpoint == "Reimbursement Request":
-        row = [
-            data['id'],
-            timestamp,
-            data['firstName'],
-            data['lastName'],
-            data['email'],
-            expense.get('approval', ''),
-            expense.get('vendor', ''),
-            expense.get('description', ''),
-            expense.get('amount', ''),
-            expense.get('hst', ''),
-            row_file_entry,
-            data.get('comments', '')
-        ]
-    elif endpoint == "Purchase Approval":
-        row = [
-            data['id'],
-            timestamp,
-            data['firstName'],
-            data['lastName'],
-            data['email'],
-            expense.get('vendor', ''),
-            expense.get('description', ''),
-            expense.get('amount', ''),
-            row_file_entry,
-            data.get('comments', '')
-        ]
-    else:
-        logger.warning("invalid endpoint, returning empty row")
-        # print ("invalid endpoint, returning empty row")
-        row = []
-    return row
+        _invalidate_on_sheet_error(endpoint, e)
+        logger.error("Error Occurred", extra={'error filling reserved rows':str(e)}, exc_info=True)
+        return False
 
 @log_execution_time
-def add_to_google_sheet(endpoint, data, file_links):
-    """Add reimbursement data to Google Sheet"""
+def release_reserved_id(endpoint, reservation):
+    """
+    Mark reserved rows as void after a failed submission. The rows are kept rather than
+    deleted so that the IDs of any later reservations are never affected.
+    """
     try:
         client = setup_google_sheets()
-        sheet = get_worksheet(client, endpoint)     #todo: add additional error handling if this fails. Create new sheet with specified name, or just return error and exit as currently?
-        
-        # Prepare row data
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        # Add each expense as a separate row
-        rows = []
-        for i, expense in enumerate(data['expenses']):
-            # add one receipt link per expense row, so file links work in google sheets
-            row_file_entry = file_links[i] if (i < len(file_links)) else '-'
-            row = buildrow(timestamp, endpoint, data, expense, row_file_entry)
-            rows.append(row)
-
-        #if there are more file links than expense rows, add extra lines
-        if (len(data['expenses']) < len(file_links)):
-            for leftover_file in file_links[len(data['expenses']):]:
-                dummy_expense = {
-                    'approval': '-',
-                    'vendor': '-',
-                    'description': '-',
-                    'amount': '-',
-                    'hst': '-'
-                }
-                row = buildrow(timestamp, endpoint, data, dummy_expense, leftover_file)
-                rows.append(row)
-
-        sheet.append_rows(rows, table_range="A1", value_input_option='USER_ENTERED')
-        
+        sheet = get_worksheet(client, endpoint)
+        start_row, end_row = reservation['start_row'], reservation['end_row']
+        with track_call('sheets', 'update'):
+            sheet.update(
+                range_name=f"A{start_row}:B{end_row}",
+                values=[[reservation['id'], VOID_MARKER]] * (end_row - start_row + 1),
+                value_input_option='USER_ENTERED'
+            )
+        RESERVATION_VOIDS.inc(endpoint=endpoint)
         return True
     except Exception as e:
-        # print(f"Error adding to Google Sheet: {e}")
-        logger.error("Error Occurred", extra={'error adding to google sheet':str(e)}, exc_info=True)
+        _invalidate_on_sheet_error(endpoint, e)
+        logger.error("Error Occurred", extra={'error releasing reserved id':str(e)}, exc_info=True)
         return False
@@ -0,0 +1,84 @@
+import re
+import threading
+
+import httplib2
+import requests
+import google_auth_httplib2
+from google.auth.transport.requests import AuthorizedSession
+from googleapiclient.discovery import build
+
+from config import Config
+from .google_auth import get_credentials, get_delegate
+
+# Shared HTTP plumbing for the Drive and Sheets modules.
+#
+# Drive: the discovery-based service object is built once per delegate, but httplib2
+# connections are not thread-safe, so every request is executed with a per-thread
+# AuthorizedHttp (each one keeps its own keep-alive connection to Google).
+# Sheets: gspread runs on requests, whose sessions can be shared between threads, so one
+# AuthorizedSession per delegate with a connection pool sized for the worker's threads.
+
+_lock = threading.Lock()
+_drive_services = {}
+_sheets_sessions = {}
+_thread_local = threading.local()
+_GOOGLE_API_ORIGIN = re.compile(r'^https://[a-z0-9-]+\.googleapis\.com')
+
+def route_google_api(url):
+    """Rewrite a Google API URL to Config.GOOGLE_API_BASE_URL when it is set (local fakes)"""
+    if not Config.GOOGLE_API_BASE_URL:
+        return url
+    return _GOOGLE_API_ORIGIN.sub(Config.GOOGLE_API_BASE_URL.rstrip('/'), url, count=1)
+
+class _RoutedHttp(httplib2.Http):
+    def request(self, uri, *args, **kwargs):
+        return super().request(route_google_api(uri), *args, **kwargs)
+
+class _RoutedAdapter(requests.adapters.HTTPAdapter):
+    def send(self, request, **kwargs):
+        request.url = route_google_api(request.url)
+        return super().send(request, **kwargs)
+
+def _new_http():
+    http_class = _RoutedHttp if Config.GOOGLE_API_BASE_URL else httplib2.Http
+    http = http_class(timeout=Config.HTTP_TIMEOUT)
+    # Drive answers resumable upload chunks with 308, which is progress, not a redirect
+    http.redirect_codes = http.redirect_codes - {308}
+    return http
+
+def get_drive_http(delegate=None):
+    """Authorized httplib2 connection for the calling thread"""
+    delegate = delegate or get_delegate()
+    connections = getattr(_thread_local, 'drive_http', None)
+    if connections is None:
+        connections = _thread_local.drive_http = {}
+    if delegate not in connections:
+        connections[delegate] = google_auth_httplib2.AuthorizedHttp(
+            get_credentials(delegate_to=delegate),
+            http=_new_http()
+        )
+    return connections[delegate]
+
+def get_drive_service(delegate=None):
+    """
+    Drive v3 service, built once per delegate. Requests made from it should be executed
+    with execute(http=get_drive_http()) so concurrent threads don't share a connection.
+    """
+    delegate = delegate or get_delegate()
+    with _lock:
+        if delegate not in _drive_services:
+            _drive_services[delegate] = build('drive', 'v3', http=get_drive_http(delegate),
+                                              cache_discovery=False)
+        return _drive_services[delegate]
+
+def get_sheets_session(delegate=None):
+    """Pooled, thread-safe requests session for gspread"""
+    delegate = delegate or get_delegate()
+    with _lock:
+        if delegate not in _sheets_sessions:
+            session = AuthorizedSession(get_credentials(delegate_to=delegate))
+            adapter_class = _RoutedAdapter if Config.GOOGLE_API_BASE_URL else requests.adapters.HTTPAdapter
+            adapter = adapter_class(pool_connections=1, pool_maxsize=Config.HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            _sheets_sessions[delegate] = session
+        return _sheets_sessions[delegate]
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from config import Config
+from .local_store import connect, transaction
+from .metrics import REGISTRY, stats_collector
+from services.logger import logger
+
+# Idempotency-Key support for the submission endpoints. A client that times out and retries
+# with the same key gets the original response back (or waits for the original request if it
+# is still running) instead of a second ID, second uploads, second rows and second emails.
+#
+# Only successful responses are replayed. If the original request failed, requests that were
+# waiting on it get the same failure, but the next retry with the key runs again. A key sent
+# again with a different submission is rejected with 422.
+#
+# Keys live in memory per worker by default; set IDEMPOTENCY_DB_PATH to keep them in a local
+# SQLite file shared by every worker on the host.
+
+MAX_KEY_LENGTH = 255
+_SQLITE_POLL_INTERVAL = 0.2
+
+_CONFLICT = ({'error': 'Idempotency-Key was already used for a different submission'}, 422)
+_BUSY = ({'error': 'A submission with this Idempotency-Key is still being processed, retry later'}, 409)
+
+def _replayable(status):
+    return 200 <= status < 300
+
+def request_fingerprint(endpoint, form, files):
+    """
+    Hash of what was submitted, to spot a key reused for a different submission. The captcha
+    token is left out since a retry may carry a fresh one, and files count by name and size.
+    """
+    digest = hashlib.sha256(endpoint.encode())
+    for key in sorted(form.keys()):
+        if key == 'captchaToken':
+            continue
+        for value in form.getlist(key):
+            digest.update(f"\0{key}={value}".encode())
+    for key in sorted(files.keys()):
+        for file in files.getlist(key):
+            file.stream.seek(0, 2)
+            size = file.stream.tell()
+            file.stream.seek(0)
+            digest.update(f"\0{key}:{file.filename}:{size}".encode())
+    return digest.hexdigest()
+
+class _Entry:
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.created_at = time.time()
+        self.response = None        # (body, status) once the original request finishes
+        self.done = threading.Event()
+
+class MemoryIdempotencyStore:
+    """Keys held in this worker: in-flight requests are waited on, completed ones kept in a bounded LRU"""
+    def __init__(self, max_size, ttl, wait_timeout):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.stats = {'replays': 0, 'waits': 0, 'conflicts': 0}
+        self._entries = OrderedDict()       # key -> _Entry, least recently used first
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        # least recently used first; in-flight entries are skipped, their owner will still finish them
+        stale = []
+        excess = len(self._entries) - self.max_size
+        for key, entry in self._entries.items():
+            if len(stale) >= excess and now - entry.created_at < self.ttl:
+                break
+            if entry.response is not None:
+                stale.append(key)
+        for key in stale:
+            del self._entries[key]
+
+    def claim(self, key, fingerprint):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry.created_at >= self.ttl and entry.response is not None:
+                entry = None
+            if entry is None or (entry.response is not None and not _replayable(entry.response[1])):
+                self._entries[key] = _Entry(fingerprint)
+                self._entries.move_to_end(key)
+                self._evict(time.time())
+                return None
+            if entry.fingerprint != fingerprint:
+                self.stats['conflicts'] += 1
+                return _CONFLICT + (False,)
+            if entry.response is None:
+                self.stats['waits'] += 1
+            self._entries.move_to_end(key)
+
+        # wait outside the lock for the original request to finish
+        if not entry.done.wait(self.wait_timeout):
+            return _BUSY + (False,)
+        with self._lock:
+            self.stats['replays'] += 1
+        return entry.response + (True,)
+
+    def finish(self, key, body, status):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry.response is None:
+            entry.response = (body, status)
+            entry.done.set()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, size=len(self._entries))
+
+class SQLiteIdempotencyStore:
+    """
+    Keys kept in a local SQLite file so every worker on the host shares them. Requests waiting
+    on another worker's in-flight request poll for its result; an in-flight key whose owner
+    hasn't finished within wait_timeout (e.g. the worker died) can be claimed again.
+    """
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        key TEXT PRIMARY KEY,
+        fingerprint TEXT NOT NULL,
+        status INTEGER,
+        body TEXT,
+        created_at REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idempotency_keys_created ON idempotency_keys (created_at);
+    """
+
+    def __init__(self, path, max_size, ttl, wait_timeout):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.stats = {'replays': 0, 'waits': 0, 'conflicts': 0}
+        self._stats_lock = threading.Lock()
+
+    def _db(self):
+        return connect(self.path, self._SCHEMA)
+
+    def _count(self, stat):
+        with self._stats_lock:
+            self.stats[stat] += 1
+
+    def claim(self, key, fingerprint):
+        now = time.time()
+        conn = self._db()
+        with transaction(conn):
+            row = conn.execute("SELECT fingerprint, status, created_at FROM idempotency_keys WHERE key = ?",
+                               (key,)).fetchone()
+            free = (row is None
+                    or now - row['created_at'] >= self.ttl
+                    or (row['status'] is not None and not _replayable(row['status']))
+                    or (row['status'] is None and now - row['created_at'] >= self.wait_timeout))
+            if free:
+                conn.execute("INSERT OR REPLACE INTO idempotency_keys (key, fingerprint, status, body, created_at) "
+                             "VALUES (?, ?, NULL, NULL, ?)", (key, fingerprint, now))
+                conn.execute("DELETE FROM idempotency_keys WHERE created_at <= ?", (now - self.ttl,))
+                conn.execute("DELETE FROM idempotency_keys WHERE key IN (SELECT key FROM idempotency_keys "
+                             "ORDER BY created_at DESC LIMIT -1 OFFSET ?) AND status IS NOT NULL", (self.max_size,))
+                return None
+        if row['fingerprint'] != fingerprint:
+            self._count('conflicts')
+            return _CONFLICT + (False,)
+        if row['status'] is None:
+            self._count('waits')
+
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            row = conn.execute("SELECT status, body FROM idempotency_keys WHERE key = ? AND fingerprint = ?",
+                               (key, fingerprint)).fetchone()
+            if row is not None and row['status'] is not None:
+                self._count('replays')
+                return json.loads(row['body']), row['status'], True
+            if row is None or time.monotonic() >= deadline:
+                return _BUSY + (False,)
+            time.sleep(_SQLITE_POLL_INTERVAL)
+
+    def finish(self, key, body, status):
+        conn = self._db()
+        conn.execute("UPDATE idempotency_keys SET status = ?, body = ? WHERE key = ? AND status IS NULL",
+                     (status, json.dumps(body), key))
+
+    def snapshot(self):
+        row = self._db().execute("SELECT COUNT(*) AS size FROM idempotency_keys").fetchone()
+        with self._stats_lock:
+            return dict(self.stats, size=row['size'])
+
+if Config.IDEMPOTENCY_DB_PATH:
+    _store = SQLiteIdempotencyStore(Config.IDEMPOTENCY_DB_PATH, Config.IDEMPOTENCY_MAX_KEYS,
+                                    Config.IDEMPOTENCY_TTL, Config.IDEMPOTENCY_WAIT_TIMEOUT)
+else:
+    _store = MemoryIdempotencyStore(Config.IDEMPOTENCY_MAX_KEYS, Config.IDEMPOTENCY_TTL,
+                                    Config.IDEMPOTENCY_WAIT_TIMEOUT)
+
+def claim(endpoint, key, fingerprint):
+    """
+    Claim an Idempotency-Key for a submission. Returns None if the caller should process the
+    request and then call finish(), otherwise the (body, status, replayed) to respond with.
+    Blocks while another request with the same key is in flight.
+    """
+    if len(key) > MAX_KEY_LENGTH:
+        return {'error': f'Idempotency-Key must be at most {MAX_KEY_LENGTH} characters'}, 400, False
+    try:
+        return _store.claim(f"{endpoint}:{key}", fingerprint)
+    except Exception as e:
+        # without the store we can't deduplicate, but the submission itself can still go ahead
+        logger.error("Error Occurred", extra={'error claiming idempotency key':str(e)}, exc_info=True)
+        return None
+
+def finish(endpoint, key, body, status):
+    """Record the response for a key claimed with claim(), waking any requests waiting on it"""
+    try:
+        _store.finish(f"{endpoint}:{key}", body, status)
+    except Exception as e:
+        logger.error("Error Occurred", extra={'error storing idempotent response':str(e)}, exc_info=True)
+
+def run_idempotent(endpoint, key, fingerprint, process):
+    """
+    Run process() -> (body, status) once per key, returns (body, status, replayed)
+    """
+    stored = claim(endpoint, key, fingerprint)
+    if stored is not None:
+        return stored
+    body, status = {'error': 'Internal server error'}, 500
+    try:
+        body, status = process()
+    finally:
+        finish(endpoint, key, body, status)
+    return body, status, False
+
+def get_idempotency_stats():
+    return _store.snapshot()
+
+REGISTRY.register_collector(stats_collector(
+    'form_backend_idempotency', 'Idempotency-Key store', get_idempotency_stats,
+    counters=('replays', 'waits', 'conflicts')))
@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+from config import Config
+from .google_sheets import TIMESTAMP_FORMAT, fill_reserved_rows
+from .local_store import connect, transaction
+from .metrics import REGISTRY, RETRIES, stats_collector
+from .tracing import span
+from services.logger import logger
+
+# Write-ahead journal for sheet writes. Once a submission has its ID reserved and its files
+# uploaded, its rows are appended to a local SQLite journal and the request is acknowledged.
+# A background replicator copies journal entries into their reserved sheet rows, oldest
+# first, retrying each with backoff, so a Sheets outage or quota throttling delays the rows
+# instead of failing the submission. Every entry has its own rows, so one that keeps failing
+# doesn't hold back the ones after it. The timestamp is taken when the entry is journaled,
+# not when it reaches the sheet. Entries are never dropped; replicated ones are pruned after
+# JOURNAL_RETENTION seconds.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    endpoint TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    replicated_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    locked_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS journal_pending ON journal (replicated_at, endpoint, seq);
+"""
+
+LEASE_SECONDS = 120
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 300
+# attempts after which a stuck entry is logged as an error on every further failure
+ALERT_AFTER_ATTEMPTS = 10
+BATCH_SIZE = 20
+
+_replicator = None
+_replicator_lock = threading.Lock()
+_wakeup = threading.Event()
+_stats_lock = threading.Lock()
+_replication_stats = {'replicated': 0, 'failures': 0}
+
+def _db():
+    return connect(Config.JOURNAL_DB_PATH, _SCHEMA)
+
+def journal_submission(endpoint, reservation, data, file_links):
+    """Durably record a submission's sheet write, returns True once it is committed locally"""
+    try:
+        payload = json.dumps({'reservation': reservation, 'data': data, 'file_links': file_links,
+                              'timestamp': datetime.now().strftime(TIMESTAMP_FORMAT)})
+        now = time.time()
+        with transaction(_db()) as conn:
+            conn.execute(
+                "INSERT INTO journal (endpoint, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+                (endpoint, payload, now, now)
+            )
+        _wakeup.set()
+        return True
+    except Exception as e:
+        logger.error("Error Occurred", extra={'error writing submission journal':str(e)}, exc_info=True)
+        return False
+
+def write_submission_rows(endpoint, reservation, data, file_links):
+    """Journal the sheet write if enabled, otherwise (or if journaling fails) write to the sheet now"""
+    with span('sheet_write'):
+        if Config.SUBMISSION_JOURNAL and journal_submission(endpoint, reservation, data, file_links):
+            return True
+        return fill_reserved_rows(endpoint, reservation, data, file_links)
+
+def _claim_due(conn):
+    """Lease the oldest unreplicated entries that are due"""
+    now = time.time()
+    with transaction(conn):
+        rows = conn.execute(
+            "SELECT seq, endpoint, payload, attempts FROM journal "
+            "WHERE replicated_at IS NULL AND next_attempt_at <= ? AND locked_until <= ? "
+            "ORDER BY seq LIMIT ?",
+            (now, now, BATCH_SIZE)
+        ).fetchall()
+        for row in rows:
+            conn.execute("UPDATE journal SET locked_until = ? WHERE seq = ?", (now + LEASE_SECONDS, row['seq']))
+    return rows
+
+def _replicate(conn, row):
+    entry = json.loads(row['payload'])
+    if fill_reserved_rows(row['endpoint'], entry['reservation'], entry['data'], entry['file_links'],
+                          entry.get('timestamp')):
+        conn.execute("UPDATE journal SET replicated_at = ?, locked_until = 0 WHERE seq = ?", (time.time(), row['seq']))
+        with _stats_lock:
+            _replication_stats['replicated'] += 1
+        return True
+
+    attempts = row['attempts'] + 1
+    delay = min(RETRY_BASE_SECONDS * (2 ** (attempts - 1)), RETRY_MAX_SECONDS)
+    conn.execute("UPDATE journal SET attempts = ?, last_error = ?, next_attempt_at = ?, locked_until = 0 WHERE seq = ?",
+                 (attempts, 'sheet write failed', time.time() + delay, row['seq']))
+    with _stats_lock:
+        _replication_stats['failures'] += 1
+    RETRIES.inc(component='journal')
+    log = logger.error if attempts >= ALERT_AFTER_ATTEMPTS else logger.warning
+    log("journal replication failed", extra={'seq': row['seq'], 'endpoint': row['endpoint'],
+                                             'id': entry['reservation']['id'], 'attempts': attempts})
+    return False
+
+def replicate_pending():
+    """Replicate journal entries until nothing is due, returns the number replicated"""
+    conn = _db()
+    replicated = 0
+    while True:
+        rows = _claim_due(conn)
+        if not rows:
+            break
+        for row in rows:
+            if _replicate(conn, row):
+                replicated += 1
+    conn.execute("DELETE FROM journal WHERE replicated_at IS NOT NULL AND replicated_at < ?",
+                 (time.time() - Config.JOURNAL_RETENTION,))
+    return replicated
+
+def get_replication_stats():
+    """Pending entry count and replication lag (age of the oldest unreplicated entry, in seconds)"""
+    row = _db().execute(
+        "SELECT COUNT(*) AS pending, MIN(created_at) AS oldest FROM journal WHERE replicated_at IS NULL"
+    ).fetchone()
+    with _stats_lock:
+        stats = dict(_replication_stats)
+    stats['pending'] = row['pending']
+    stats['lag_seconds'] = time.time() - row['oldest'] if row['oldest'] else 0.0
+    return stats
+
+REGISTRY.register_collector(stats_collector(
+    'form_backend_journal', 'Submission journal replication',
+    lambda: get_replication_stats() if Config.SUBMISSION_JOURNAL else {},
+    counters=('replicated', 'failures')))
+
+def _replicator_loop():
+    while True:
+        _wakeup.clear()
+        try:
+            replicate_pending()
+        except Exception as e:
+            logger.error("Error Occurred", extra={'error replicating submission journal':str(e)}, exc_info=True)
+        _wakeup.wait(Config.JOURNAL_POLL_INTERVAL)
+
+def start_journal_replicator():
+    """Start the background replicator (once per process), picking up entries left from before a restart"""
+    global _replicator
+    with _replicator_lock:
+        if _replicator is None:
+            _replicator = threading.Thread(target=_replicator_loop, name='journal-replicator', daemon=True)
+            _replicator.start()
@@ -0,0 +1,44 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Small helpers for the local SQLite files used to keep state off the request path.
+# sqlite3 connections can't be shared between threads, so each thread gets its own
+# connection per database file. WAL mode lets readers and one writer work concurrently,
+# including across gunicorn workers on the same host.
+
+_thread_local = threading.local()
+_schema_lock = threading.Lock()
+_initialised = set()
+
+def connect(path, schema=None):
+    """Return this thread's connection to the database at path, creating the schema once"""
+    connections = getattr(_thread_local, 'connections', None)
+    if connections is None:
+        connections = _thread_local.connections = {}
+
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        connections[path] = conn
+
+    if schema:
+        with _schema_lock:
+            if (path, schema) not in _initialised:
+                conn.executescript(schema)
+                _initialised.add((path, schema))
+    return conn
+
+@contextmanager
+def transaction(conn):
+    """Write transaction that takes the database lock up front (BEGIN IMMEDIATE)"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
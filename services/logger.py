@@ -1,27 +1,64 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import queue
 import sys
-from functools import wraps
-import time
-import uuid
-from flask import request, g, has_request_context
+from flask import g, has_request_context
+
+from config import Config
+from services.tracing import current_trace
+
+# attributes every LogRecord has; anything else on a record came from extra={...}
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_listener = None
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with extra= fields (errors, durations, ...) as top-level keys"""
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'name': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
 
 def setup_logger():
-    """Configure application logger for production."""
+    """
+    Configure application logger for production.
+    Records are formatted in the calling thread and handed to a queue; a listener thread
+    does the actual writing, so request threads never block on stdout.
+    """
+    global _listener
     logger = logging.getLogger('form_app')
-    logger.setLevel(logging.INFO)
-    
-    # Console handler (stdout for container logs)
+    logger.setLevel(Config.LOG_LEVEL)
+    if _listener is not None:
+        return logger
+
+    # Console handler (stdout for container logs); records arrive already formatted
     handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.INFO)
-    
-    # JSON-like format for easier parsing
-    formatter = logging.Formatter(
-        '{"time":"%(asctime)s", "level":"%(levelname)s", "name":"%(name)s", '
-        '"message":"%(message)s", "request_id":"%(request_id)s"}'
-    )
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    
+    handler.setFormatter(logging.Formatter('%(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(JSONFormatter())
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(_listener.stop)     # flush whatever is still queued on shutdown
+
     return logger
 
 # Create logger instance
@@ -30,33 +67,12 @@ logger = logging.getLogger('form_app')
 class RequestIDFilter(logging.Filter):
     """Add request ID to all log records."""
     def filter(self, record):
+        if getattr(record, 'request_id', None):
+            return True
         if has_request_context():
             record.request_id = getattr(g, 'request_id', 'no-request')
         else:
-            record.request_id = 'startup'
+            # worker threads and the ASGI app carry the request's trace instead
+            trace = current_trace()
+            record.request_id = trace.request_id if trace is not None else 'startup'
         return True
-
-def log_execution_time(func):
-    """Decorator to log function execution time."""
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        start = time.time()
-        func_name = func.__name__
-        logger.info(f"Starting {func_name}")
-        
-        try:
-            result = func(*args, **kwargs)
-            duration = time.time() - start
-            logger.info(f"Completed {func_name}", extra={
-                'duration_seconds': f"{duration:.2f}"
-            })
-            return result
-        except Exception as e:
-            duration = time.time() - start
-            logger.error(f"Failed {func_name}", extra={
-                'duration_seconds': f"{duration:.2f}",
-                'error': str(e)
-            })
-            raise
-    
-    return wrapper
\ No newline at end of file
@@ -0,0 +1,200 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process metrics, rendered in the Prometheus text exposition format at /metrics.
+# Counters and histograms are updated from request and background threads, so every
+# metric guards its values with its own lock. Stats that modules already keep (cache
+# hits, replication lag, ...) are not duplicated: they register a collector that is
+# called at scrape time instead.
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple((name, labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}       # label key -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple((name, labels.get(name, '')) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            snapshot = {key: list(counts) for key, counts in self._values.items()}
+        samples = []
+        for key, counts in snapshot.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', key + (('le', _format_value(float(bound))),), cumulative))
+            samples.append((self.name + '_count', key, cumulative))
+            samples.append((self.name + '_sum', key, counts[-1]))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector):
+        """
+        collector() is called on every scrape and returns a list of
+        (name, type, documentation, labels dict, value) samples
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        with self._lock:
+            metrics, collectors = list(self._metrics), list(self._collectors)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+
+        families = {}
+        for collector in collectors:
+            try:
+                samples = collector()
+            except Exception:
+                continue        # a broken stats source shouldn't take the endpoint down
+            for name, metric_type, documentation, labels, value in samples:
+                family = families.setdefault(name, (metric_type, documentation, []))
+                family[2].append((tuple(sorted(labels.items())), value))
+        for name, (metric_type, documentation, samples) in families.items():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for key, value in samples:
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+EXTERNAL_CALL_SECONDS = REGISTRY.histogram(
+    'form_backend_external_call_seconds', 'Latency of calls to Google, hCaptcha, Slack and SMTP',
+    ('service', 'operation'))
+EXTERNAL_CALL_FAILURES = REGISTRY.counter(
+    'form_backend_external_call_failures_total', 'External calls that raised or returned an error',
+    ('service', 'operation'))
+STAGE_SECONDS = REGISTRY.histogram(
+    'form_backend_stage_seconds', 'Duration of traced submission stages', ('stage',))
+HTTP_REQUESTS = REGISTRY.counter(
+    'form_backend_http_requests_total', 'HTTP requests handled', ('path', 'method', 'status'))
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'form_backend_http_request_seconds', 'HTTP request latency', ('path',))
+RETRIES = REGISTRY.counter(
+    'form_backend_retries_total', 'Operations retried after a failure', ('component',))
+RESERVATION_VOIDS = REGISTRY.counter(
+    'form_backend_reservation_voids_total', 'Reserved IDs voided after a failed submission', ('endpoint',))
+RECEIPT_DEDUP = REGISTRY.counter(
+    'form_backend_receipt_dedup_total', 'Receipts not uploaded because an identical file was already stored',
+    ('source',))
+RECEIPT_DEDUP_BYTES = REGISTRY.counter(
+    'form_backend_receipt_dedup_bytes_total', 'Upload bytes saved by receipt deduplication')
+ROLLBACK_DELETES = REGISTRY.counter(
+    'form_backend_rollback_deletes_total', 'Uploaded files deleted when rolling back a submission', ('result',))
+
+@contextmanager
+def track_call(service, operation):
+    """Time an external call; an exception counts as a failure and is re-raised"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        EXTERNAL_CALL_FAILURES.inc(service=service, operation=operation)
+        raise
+    finally:
+        EXTERNAL_CALL_SECONDS.observe(time.perf_counter() - start, service=service, operation=operation)
+
+def record_failure(service, operation):
+    """Count a failed external call that reported its error without raising"""
+    EXTERNAL_CALL_FAILURES.inc(service=service, operation=operation)
+
+def stats_collector(prefix, documentation, stats_fn, counters=()):
+    """
+    Collector exposing a module's stats dict: keys in `counters` become prefix_<key>_total
+    counters, everything else a prefix_<key> gauge
+    """
+    def collect():
+        samples = []
+        for key, value in stats_fn().items():
+            if key in counters:
+                samples.append((f"{prefix}_{key}_total", 'counter', f"{documentation} ({key})", {}, value))
+            else:
+                samples.append((f"{prefix}_{key}", 'gauge', f"{documentation} ({key})", {}, value))
+        return samples
+    return collect
+
+def render_metrics():
+    return REGISTRY.render()
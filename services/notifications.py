@@ -1,22 +1,147 @@
 import json
+import os
 import requests
 import smtplib
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from jinja2 import Template
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from email.mime.base import MIMEBase
 from email import encoders
 
 from config import Config
+from .forms import FORMS
+from .metrics import RETRIES, record_failure, track_call
 from .utils import log_execution_time
 from services.logger import logger
 
+# errors meaning the server hung up (SMTPException subclasses OSError, so list these explicitly)
+_SMTP_DISCONNECTED = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+class SMTPConnectionPool:
+    """
+    Thread-safe pool of logged-in SMTP connections, so each message doesn't pay for
+    connect + STARTTLS + login. Idle connections are closed after idle_timeout, checked with
+    NOOP if they've been idle for a while, and a send that finds the server has hung up is
+    retried once on a fresh connection.
+    """
+    def __init__(self, host, port, username=None, password=None, starttls=True,
+                 max_size=2, idle_timeout=60, health_check_after=10, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.timeout = timeout
+        self._idle = []     # (connection, last_used)
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            server.starttls()
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    @staticmethod
+    def _healthy(server):
+        try:
+            return server.noop()[0] == 250
+        except Exception:
+            return False
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, last_used = self._idle.pop()
+            idle_for = time.monotonic() - last_used
+            if idle_for > self.idle_timeout or \
+                    (idle_for > self.health_check_after and not self._healthy(server)):
+                self._close(server)
+                continue
+            return server
+        return self._connect()
+
+    def _checkin(self, server):
+        with self._lock:
+            self._idle.append((server, time.monotonic()))
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; it goes back to the pool unless the server disconnected"""
+        with self._slots:
+            server = self._checkout()
+            try:
+                yield server
+            except Exception:
+                # don't hand out a connection in an unknown state
+                self._close(server)
+                raise
+            self._checkin(server)
+
+    def send_message(self, msg):
+        with track_call('smtp', 'send'):
+            try:
+                with self.connection() as server:
+                    server.send_message(msg)
+            except _SMTP_DISCONNECTED:
+                # pooled connection went stale under us, try once more on a new one
+                RETRIES.inc(component='smtp')
+                with self.connection() as server:
+                    server.send_message(msg)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._close(server)
+
+_smtp_pools = {}
+_smtp_pools_lock = threading.Lock()
+
+def get_smtp_pool(sender_email):
+    """Pool of connections logged in as sender_email"""
+    with _smtp_pools_lock:
+        if sender_email not in _smtp_pools:
+            _smtp_pools[sender_email] = SMTPConnectionPool(
+                Config.SMTP_SERVER, Config.SMTP_PORT, sender_email, Config.EMAIL_PASSWORD,
+                starttls=Config.SMTP_STARTTLS, max_size=Config.SMTP_POOL_SIZE, idle_timeout=Config.SMTP_IDLE_TIMEOUT
+            )
+        return _smtp_pools[sender_email]
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
+
+# Templates are compiled once and kept in memory (no per-render file reads or mtime checks);
+# the bytecode cache lets restarted workers skip compiling them again.
+_jinja_env = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    bytecode_cache=FileSystemBytecodeCache(),
+    auto_reload=False
+)
+_jinja_env.get_template('email_template.html')      # compile at startup
+
 def render_email_template(template_name, **context):
     """Render email template with context"""
-    with open(f'templates/{template_name}', 'r') as f:
-        template = Template(f.read())
-    return template.render(**context)
+    return _jinja_env.get_template(template_name).render(**context)
 
 @log_execution_time
 def send_slack_notification(data, file_links):
@@ -99,8 +224,12 @@ def send_slack_notification(data, file_links):
                 }
             })
         
-        response = requests.post(Config.SLACK_WEBHOOK_URL, json=message, timeout=10)
-        return response.status_code == 200
+        with track_call('slack', 'webhook'):
+            response = requests.post(Config.SLACK_WEBHOOK_URL, json=message, timeout=10)
+        if response.status_code != 200:
+            record_failure('slack', 'webhook')
+            return False
+        return True
     except Exception as e:
         # print(f"Error sending Slack notification: {e}")
         logger.error("Error Occurred", extra={'error sending slack notification':str(e)}, exc_info=True)
@@ -144,42 +273,44 @@ HST: {exp.get('hst', 'N/A')}
 
     return plain_body
 
-def email_builder(endpoint, data, file_links, email_type):
-    """Build email HTML from unified template"""
-    form_specific = {
-        "Reimbursement Request": {
-            "message": "Thank you for submitting your request! Our Treasurer will be in touch if there are any issues."
-        },
-        "Purchase Approval": {
-            "message": "Thank you for submitting your purchase approval request! Remember to keep an eye on the member's list for questions and +1s from the Board."
-        }
-    }
-
+def build_email_context(endpoint, data, file_links):
+    """Template context shared by every email sent for one submission"""
     # Calculate total
     expenses = data['expenses']  # Already parsed as list of dicts
     total = sum(float(exp.get('amount', 0) or 0) for exp in expenses)
-    
+
+    return {
+        'form_type': endpoint,
+        'message': FORMS[endpoint].message,
+        'first_name': data['firstName'],
+        'last_name': data['lastName'],
+        'email': data['email'],
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'expenses': expenses,
+        'total': total,
+        'comments': data.get('comments', ''),
+        'file_links': file_links
+    }
+
+def email_builder(endpoint, data, file_links, email_type, context=None):
+    """Build email HTML from unified template"""
+    if context is None:
+        context = build_email_context(endpoint, data, file_links)
+
     # Render unified template
-    html_body = render_email_template(
-        'email_template.html',
-        email_type=email_type,
-        form_type=endpoint,
-        message=form_specific[endpoint]["message"],
-        first_name=data['firstName'],
-        last_name=data['lastName'],
-        email=data['email'],
-        timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-        expenses=expenses,
-        total=total,
-        comments=data.get('comments', ''),
-        file_links=file_links
-    )
+    html_body = render_email_template('email_template.html', email_type=email_type, **context)
 
     return html_body
 
+EMAIL_MESSAGES = ('list', 'acknowledgment')
+
 @log_execution_time
-def send_email_notification(endpoint, data, file_links):
-    """Send email notification with file links instead of attachments"""
+def send_email_notification(endpoint, data, file_links, messages=EMAIL_MESSAGES):
+    """
+    Send email notification with file links instead of attachments.
+    messages: which of EMAIL_MESSAGES to send. Returns True only if all of them went out,
+    so the outbox can retry each message on its own.
+    """
     try:
         sender_email = Config.DEV_OUTBOUND_EMAIL_ADDRESS if Config.FLASK_ENV == "development" else Config.OUTBOUND_EMAIL_ADDRESS
         if not all([sender_email, Config.EMAIL_PASSWORD]):
@@ -187,51 +318,32 @@ def send_email_notification(endpoint, data, file_links):
             logger.warning("Email credentials not fully configured")
             return False
         
-        recipient_email = Config.DEV_RECIPIENT_EMAIL if Config.FLASK_ENV == "development" else Config.RECIPIENT_EMAIL[endpoint]
+        recipient_email = Config.DEV_RECIPIENT_EMAIL if Config.FLASK_ENV == "development" else FORMS[endpoint].recipient_email
         if not recipient_email:
             # print(f"Warning: No recipient email configured for {endpoint}")
             logger.warning(f"Warning: No recipient email configured for {endpoint}")
             return False
 
-        # Render both emails from unified template
-        list_notify_html_body = email_builder(endpoint, data, file_links, "list")
-        thanks_html_body = email_builder(endpoint, data, file_links, "acknowledgment")
-
-        # Create both messages
-        list_msg = MIMEMultipart('alternative')
-        list_msg['From'] = sender_email
-        list_msg['To'] = recipient_email
-        list_msg['Subject'] = f"New {endpoint} - {data['firstName']} {data['lastName']}"
-        list_msg.attach(MIMEText(list_notify_html_body, 'html'))
-
-        ack_msg = MIMEMultipart('alternative')
-        ack_msg['From'] = sender_email
-        ack_msg['To'] = data["email"]
-        ack_msg['Subject'] = f"New {endpoint} - {data['firstName']} {data['lastName']}"
-        ack_msg.attach(MIMEText(thanks_html_body, 'html'))
-        
-        server = smtplib.SMTP(Config.SMTP_SERVER, Config.SMTP_PORT)
-        server.starttls()
-        server.login(sender_email, Config.EMAIL_PASSWORD)
-        
-        list_sent = False
-        ack_sent = False
-        
-        try:
-            server.send_message(list_msg)
-            list_sent = True
-        except Exception as e:
-            # print(f"Failed to send list notification: {e}")
-            logger.exception("Exception Occurred", extra={'failed to send list notification':str(e)}, exc_info=True)
-        try:
-            server.send_message(ack_msg)
-            ack_sent = True
-        except Exception as e:
-            # print(f"Failed to send acknowledgement: {e}")
-            logger.exception("Exception Occurred", extra={'failed to send acknowledgement':str(e)}, exc_info=True)
-            
-        server.quit()
-        return list_sent or ack_sent
+        # Render the requested emails from the unified template
+        context = build_email_context(endpoint, data, file_links)
+        recipients = {'list': recipient_email, 'acknowledgment': data["email"]}
+
+        pool = get_smtp_pool(sender_email)
+
+        all_sent = True
+        for email_type in messages:
+            msg = MIMEMultipart('alternative')
+            msg['From'] = sender_email
+            msg['To'] = recipients[email_type]
+            msg['Subject'] = f"New {endpoint} - {data['firstName']} {data['lastName']}"
+            msg.attach(MIMEText(email_builder(endpoint, data, file_links, email_type, context), 'html'))
+            try:
+                pool.send_message(msg)
+            except Exception as e:
+                logger.exception("Exception Occurred", extra={f'failed to send {email_type} email':str(e)}, exc_info=True)
+                all_sent = False
+
+        return all_sent
     except Exception as e:
         print(f"Error sending email: {e}")
         logger.error("Error Occurred", extra={'error sending email':str(e)}, exc_info=True)
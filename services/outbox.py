@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+
+from config import Config
+from .local_store import connect, transaction
+from .metrics import REGISTRY, RETRIES
+from .notifications import EMAIL_MESSAGES, send_slack_notification, send_email_notification
+from .tracing import span
+from services.logger import logger
+
+# Durable outbox for Slack and email notifications. Endpoints record the notification in
+# a local SQLite table and return; a background dispatcher delivers it, retrying with
+# backoff and dead-lettering after OUTBOX_MAX_ATTEMPTS. Rows are leased while being sent
+# so several workers sharing the file never deliver the same notification twice at once.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    locked_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS notifications_due ON notifications (status, next_attempt_at);
+"""
+
+LEASE_SECONDS = 120
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+BATCH_SIZE = 10
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+_wakeup = threading.Event()
+
+def _send(kind, payload):
+    if kind == 'slack':
+        return send_slack_notification(payload['data'], payload['file_links'])
+    elif kind == 'email':
+        messages = (payload['message'],) if payload.get('message') else EMAIL_MESSAGES
+        return send_email_notification(payload['endpoint'], payload['data'], payload['file_links'], messages)
+    raise ValueError(f"unknown notification kind: {kind}")
+
+def _db():
+    return connect(Config.OUTBOX_DB_PATH, _SCHEMA)
+
+def enqueue_notification(kind, endpoint, data, file_links):
+    """
+    Record a notification for background delivery, returns True once it is durably stored.
+    An email becomes one row per message, so a failed acknowledgment is retried without
+    sending the list notification again (and vice versa).
+    """
+    try:
+        messages = EMAIL_MESSAGES if kind == 'email' else (None,)
+        now = time.time()
+        with transaction(_db()) as conn:
+            for message in messages:
+                payload = json.dumps({'endpoint': endpoint, 'data': data, 'file_links': file_links, 'message': message})
+                conn.execute(
+                    "INSERT INTO notifications (kind, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                    (kind, payload, now, now)
+                )
+        _wakeup.set()
+        return True
+    except Exception as e:
+        logger.error("Error Occurred", extra={'error queueing notification':str(e)}, exc_info=True)
+        return False
+
+def deliver_notification(kind, endpoint, data, file_links):
+    """Queue a notification through the outbox if enabled, otherwise (or if queueing fails) send it now"""
+    with span(f'notify_{kind}'):
+        if Config.NOTIFICATION_OUTBOX and enqueue_notification(kind, endpoint, data, file_links):
+            return True
+        return _send(kind, {'endpoint': endpoint, 'data': data, 'file_links': file_links})
+
+def _claim_due(conn):
+    now = time.time()
+    with transaction(conn):
+        rows = conn.execute(
+            "SELECT id, kind, payload, attempts FROM notifications "
+            "WHERE status = 'pending' AND next_attempt_at <= ? AND locked_until <= ? "
+            "ORDER BY id LIMIT ?",
+            (now, now, BATCH_SIZE)
+        ).fetchall()
+        for row in rows:
+            conn.execute("UPDATE notifications SET locked_until = ? WHERE id = ?",
+                         (now + LEASE_SECONDS, row['id']))
+    return rows
+
+def _record_result(conn, row, sent, error=None):
+    if sent:
+        conn.execute("DELETE FROM notifications WHERE id = ?", (row['id'],))
+        return
+
+    attempts = row['attempts'] + 1
+    RETRIES.inc(component=f"outbox_{row['kind']}")
+    if attempts >= Config.OUTBOX_MAX_ATTEMPTS:
+        logger.error("notification dead-lettered", extra={'notification_id': row['id'], 'kind': row['kind'],
+                                                          'attempts': attempts, 'error': error})
+        conn.execute("UPDATE notifications SET status = 'dead', attempts = ?, last_error = ?, locked_until = 0 "
+                     "WHERE id = ?", (attempts, error, row['id']))
+    else:
+        delay = min(RETRY_BASE_SECONDS * (2 ** (attempts - 1)), RETRY_MAX_SECONDS)
+        conn.execute("UPDATE notifications SET attempts = ?, last_error = ?, next_attempt_at = ?, locked_until = 0 "
+                     "WHERE id = ?", (attempts, error, time.time() + delay, row['id']))
+
+def dispatch_due_notifications():
+    """Deliver every notification that is due, returns the number processed"""
+    conn = _db()
+    processed = 0
+    while True:
+        rows = _claim_due(conn)
+        if not rows:
+            return processed
+        for row in rows:
+            error = None
+            try:
+                sent = _send(row['kind'], json.loads(row['payload']))
+                if not sent:
+                    error = 'sender reported failure'
+            except Exception as e:
+                sent, error = False, str(e)
+            _record_result(conn, row, sent, error)
+            processed += 1
+
+def _collect_queue_sizes():
+    """Outbox rows by kind and status, for /metrics"""
+    if not Config.NOTIFICATION_OUTBOX:
+        return []
+    rows = _db().execute("SELECT kind, status, COUNT(*) AS n FROM notifications GROUP BY kind, status").fetchall()
+    return [('form_backend_outbox_notifications', 'gauge', 'Notifications waiting in the outbox (pending) or given up on (dead)',
+             {'kind': row['kind'], 'status': row['status']}, row['n']) for row in rows]
+
+REGISTRY.register_collector(_collect_queue_sizes)
+
+def _dispatcher_loop():
+    while True:
+        _wakeup.clear()
+        try:
+            dispatch_due_notifications()
+        except Exception as e:
+            logger.error("Error Occurred", extra={'error dispatching notifications':str(e)}, exc_info=True)
+        _wakeup.wait(Config.OUTBOX_POLL_INTERVAL)
+
+def start_outbox_dispatcher():
+    """Start the background dispatcher (once per process), delivering anything left from before a restart"""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = threading.Thread(target=_dispatcher_loop, name='outbox-dispatcher', daemon=True)
+            _dispatcher.start()
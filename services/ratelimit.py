@@ -0,0 +1,162 @@
+import math
+import sqlite3
+import time
+
+from limits import parse
+from limits.storage import MemoryStorage, Storage, SlidingWindowCounterSupport, storage_from_string
+from limits.strategies import STRATEGIES
+
+from .local_store import connect, transaction
+from services.logger import logger
+
+# Shared counter storage for flask-limiter. With the default memory:// storage every gunicorn
+# worker keeps its own counts, so N workers allow N times the configured limit, and the counts
+# are lost on every restart. Importing this module registers a "sqlite" scheme with `limits`:
+#   RATELIMIT_STORAGE_URI=sqlite:///ratelimit.sqlite3      (relative path)
+#   RATELIMIT_STORAGE_URI=sqlite:////var/run/ratelimit.db  (absolute path)
+# which all workers on a host share. For several instances point it at Redis instead
+# (redis://host:6379, needs the `redis` package); `limits` handles that scheme itself.
+#
+# Only the fixed-window and sliding-window-counter strategies are supported. The sliding
+# window counter keeps two counters per key (this window and the previous one) and weights
+# the previous count by how much of it still overlaps the window, so it costs one small
+# transaction per hit instead of storing a timestamp per request like moving-window.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rate_limits_expiry ON rate_limits (expires_at);
+"""
+
+# expired rows are swept at most this often, instead of on every hit
+_SWEEP_INTERVAL = 60
+
+class SQLiteStorage(Storage, SlidingWindowCounterSupport):
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri, wrap_exceptions=False, **options):
+        # sqlite:///relative.db or sqlite:////absolute/path.db
+        self.path = uri.split('://', 1)[1][1:] or 'ratelimit.sqlite3'
+        self._last_sweep = 0
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def _conn(self):
+        return connect(self.path, _SCHEMA)
+
+    def _sweep(self, conn, now):
+        if now - self._last_sweep > _SWEEP_INTERVAL:
+            self._last_sweep = now
+            conn.execute("DELETE FROM rate_limits WHERE expires_at <= ?", (now,))
+
+    def _read(self, conn, key, now):
+        row = conn.execute("SELECT count, expires_at FROM rate_limits WHERE key = ?", (key,)).fetchone()
+        if row is None or row['expires_at'] <= now:
+            return 0, now
+        return row['count'], row['expires_at']
+
+    def _add(self, conn, key, expiry, amount, now, elastic_expiry=False):
+        """Add amount to key (starting a new window if it expired), returns the new count"""
+        conn.execute(
+            """INSERT INTO rate_limits (key, count, expires_at) VALUES (?, ?, ?)
+               ON CONFLICT(key) DO UPDATE SET
+                   count = CASE WHEN expires_at <= ? THEN excluded.count ELSE count + excluded.count END,
+                   expires_at = CASE WHEN expires_at <= ? OR ? THEN excluded.expires_at ELSE expires_at END""",
+            (key, amount, now + expiry, now, now, elastic_expiry))
+        return conn.execute("SELECT count FROM rate_limits WHERE key = ?", (key,)).fetchone()['count']
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        now = time.time()
+        conn = self._conn()
+        with transaction(conn):
+            self._sweep(conn, now)
+            return self._add(conn, key, expiry, amount, now, elastic_expiry)
+
+    def get(self, key):
+        return self._read(self._conn(), key, time.time())[0]
+
+    def get_expiry(self, key):
+        return self._read(self._conn(), key, time.time())[1]
+
+    def check(self):
+        try:
+            self._conn().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        conn = self._conn()
+        with transaction(conn):
+            return conn.execute("DELETE FROM rate_limits").rowcount
+
+    def clear(self, key):
+        conn = self._conn()
+        with transaction(conn):
+            prefix = f"{key}/sw/"
+            conn.execute("DELETE FROM rate_limits WHERE key = ? OR substr(key, 1, ?) = ?",
+                         (key, len(prefix), prefix))
+
+    ########### Sliding window counter ####################
+
+    def _window_keys(self, key, expiry, now):
+        window = int(now // expiry)
+        return f"{key}/sw/{window - 1}", f"{key}/sw/{window}"
+
+    def _window_info(self, conn, key, expiry, now):
+        previous_key, current_key = self._window_keys(key, expiry, now)
+        previous_count = self._read(conn, previous_key, now)[0]
+        current_count = self._read(conn, current_key, now)[0]
+        # time until the previous window stops overlapping the sliding window
+        previous_ttl = (1 - (now / expiry) % 1) * expiry if previous_count else 0
+        current_ttl = (1 - (now / expiry) % 1) * expiry + expiry
+        return previous_count, previous_ttl, current_count, current_ttl
+
+    def acquire_sliding_window_entry(self, key, limit, expiry, amount=1):
+        if amount > limit:
+            return False
+        now = time.time()
+        conn = self._conn()
+        # read and increment in one write transaction, so concurrent workers can't both
+        # take the last slot
+        with transaction(conn):
+            self._sweep(conn, now)
+            previous_count, previous_ttl, current_count, _ = self._window_info(conn, key, expiry, now)
+            weighted = previous_count * previous_ttl / expiry + current_count
+            if math.floor(weighted) + amount > limit:
+                return False
+            # counters live for two windows so they can still be read as the previous window
+            window_end = (int(now // expiry) + 1) * expiry
+            self._add(conn, self._window_keys(key, expiry, now)[1], window_end + expiry - now, amount, now)
+            return True
+
+    def get_sliding_window(self, key, expiry):
+        return self._window_info(self._conn(), key, expiry, time.time())
+
+    def clear_sliding_window(self, key, expiry):
+        self.clear(key)
+
+class RequestLimiter:
+    """
+    Per-client limit for servers without Flask-Limiter (the ASGI app). Uses the same storage
+    and strategy as the Flask limiter and, like swallow_errors + in_memory_fallback there,
+    falls back to per-process counters while the storage is unreachable.
+    """
+    def __init__(self, limit, storage_uri, strategy):
+        self.limit = parse(limit)
+        self._limiter = STRATEGIES[strategy](storage_from_string(storage_uri))
+        self._fallback = STRATEGIES[strategy](MemoryStorage())
+
+    def hit(self, *identifiers):
+        """Count a request, returns False if it is over the limit"""
+        try:
+            return self._limiter.hit(self.limit, *identifiers)
+        except Exception as e:
+            logger.error("Error Occurred", extra={'error checking rate limit':str(e)}, exc_info=True)
+            return self._fallback.hit(self.limit, *identifiers)
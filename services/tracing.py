@@ -0,0 +1,97 @@
+import contextvars
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from .metrics import STAGE_SECONDS
+
+# services.logger imports this module for request IDs, so get the logger directly
+logger = logging.getLogger('form_app')
+
+# Per-request stage timing. A Trace is started for each request and kept in a context
+# variable; span() records how long a stage took into whatever trace is current. Work handed
+# to a thread pool has to be submitted with submit_in_context() (or services.aio.run_sync)
+# so its spans land in the request's trace. At the end of the request the spans are logged
+# as one record and returned to the client in a Server-Timing header.
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_METRIC_NAME = re.compile(r'[^A-Za-z0-9_-]')
+
+class Trace:
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name, start, duration, detail=None, ok=True):
+        with self._lock:
+            self.spans.append({
+                'name': name,
+                'detail': detail,
+                'start_ms': round((start - self.started) * 1000, 1),
+                'duration_ms': round(duration * 1000, 1),
+                'ok': ok
+            })
+
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def summary(self):
+        """Spans in start order, for the structured timing log"""
+        with self._lock:
+            return sorted(self.spans, key=lambda s: s['start_ms'])
+
+    def server_timing(self):
+        """Server-Timing header value: one entry per span plus the total so far"""
+        entries = []
+        for s in self.summary():
+            entry = f"{_METRIC_NAME.sub('_', s['name'])};dur={s['duration_ms']}"
+            if s['detail']:
+                entry += ';desc="' + str(s['detail']).replace('\\', '').replace('"', '') + '"'
+            entries.append(entry)
+        entries.append(f"total;dur={self.elapsed_ms()}")
+        return ', '.join(entries)
+
+def start_trace(request_id):
+    """Begin a trace for the current request, returns (trace, token) for end_trace"""
+    trace = Trace(request_id)
+    return trace, _current_trace.set(trace)
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+def current_trace():
+    return _current_trace.get()
+
+def log_trace(trace, **fields):
+    """Emit a request's spans as one structured log record"""
+    logger.info("request timing", extra={
+        'request_id': trace.request_id,
+        'duration_ms': trace.elapsed_ms(),
+        'spans': trace.summary(),
+        **fields
+    })
+
+@contextmanager
+def span(name, detail=None):
+    """Time the enclosed block as a stage of the current request (no-op outside a request)"""
+    trace = _current_trace.get()
+    start = time.perf_counter()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=name)
+        if trace is not None:
+            trace.add(name, start, duration, detail, ok)
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """executor.submit, but the task runs in a copy of the caller's context (and trace)"""
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
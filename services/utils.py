@@ -1,12 +1,40 @@
+import logging
+import random
 import time
 from functools import wraps
 
+from config import Config
+from services.logger import logger
+
+_TIMING_LEVEL = logging.getLevelName(Config.LOG_TIMING_LEVEL)
+
 def log_execution_time(func):
+    """
+    Log when a function starts and how long it took (perf_counter). These lines are
+    high-volume, so they use LOG_TIMING_LEVEL and are sampled at LOG_TIMING_SAMPLE_RATE;
+    slow calls (LOG_SLOW_CALL_MS) and failures are always logged.
+    """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        duration = time.time() - start
-        print(f"{func.__name__} took {duration:.2f} seconds")
+        func_name = func.__name__
+        sampled = Config.LOG_TIMING_SAMPLE_RATE >= 1 or random.random() < Config.LOG_TIMING_SAMPLE_RATE
+        if sampled:
+            logger.log(_TIMING_LEVEL, f"Starting {func_name}")
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            logger.error(f"Failed {func_name}", extra={
+                'function': func_name,
+                'duration_ms': round((time.perf_counter() - start) * 1000, 1),
+                'error': str(e)
+            })
+            raise
+        duration_ms = round((time.perf_counter() - start) * 1000, 1)
+        if sampled or duration_ms >= Config.LOG_SLOW_CALL_MS:
+            logger.log(_TIMING_LEVEL, f"Completed {func_name}", extra={
+                'function': func_name,
+                'duration_ms': duration_ms
+            })
         return result
-    return wrapper
\ No newline at end of file
+    return wrapper
@@ -1,3 +1,4 @@
+import math
 import re
 import mimetypes
 from werkzeug.utils import secure_filename
@@ -25,61 +26,109 @@ MAX_NAME_LENGTH = 100
 MAX_EMAIL_LENGTH = 255
 MAX_TEXT_FIELD_LENGTH = 500
 MAX_COMMENTS_LENGTH = 2000
+# Raw text longer than this many times a field's limit is rejected before it is sanitized
+RAW_LENGTH_FACTOR = 4
+
+# HTML tags stripped from text inputs, then javascript: and event handler attributes (onclick=
+# etc.). Brackets that don't form a tag ("<1m", "5 > 3") are kept. Both scans are linear: tags
+# are only looked for up to the last >, where every < is closed by the next > after it.
+_HTML_TAG = re.compile(r'<[^>]*>')
+_UNSAFE_MARKUP = re.compile(r'javascript:|\bon\w+\s*=', re.IGNORECASE)
+# Basic email regex - not perfect but catches most invalid formats
+_EMAIL_PATTERN = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+# Only this many errors are listed in the response, the rest are counted
+MAX_REPORTED_ERRORS = 20
+
+VALID_HST_OPTIONS = (
+    'HST included in amount',
+    'HST excluded from amount',
+    'HST not charged'
+)
 
 def sanitize_html(text):
     """Remove HTML tags and dangerous characters from text input"""
     if not text:
         return text
-    
-    # Remove HTML tags
-    text = re.sub(r'<[^>]*>', '', str(text))
-    
-    # Remove common XSS patterns
-    text = re.sub(r'javascript:', '', text, flags=re.IGNORECASE)
-    text = re.sub(r'on\w+\s*=', '', text, flags=re.IGNORECASE)
-    
+
+    # Matches become spaces rather than being cut out, so the text either side can't join up
+    # into a new javascript: or handler. No < is left before the last > and no > after it,
+    # so no tag survives either
+    text = str(text)
+    end = text.rfind('>') + 1
+    text = _HTML_TAG.sub(' ', text[:end]) + text[end:]
+    text = _UNSAFE_MARKUP.sub(' ', text)
+
     # Normalize whitespace
-    text = ' '.join(text.split())
-    
-    return text.strip()
+    return ' '.join(text.split())
 
 def validate_email(email):
     """Validate email format"""
     if not email or len(email) > MAX_EMAIL_LENGTH:
         return False
-    
-    # Basic email regex - not perfect but catches most invalid formats
-    email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(email_pattern, email) is not None
+    return _EMAIL_PATTERN.fullmatch(email) is not None
 
-def validate_decimal(value, field_name="amount"):
-    """Validate that a value is a valid decimal number"""
-    if not value:
-        return False, f"{field_name} is required"
-    
-    try:
-        decimal_val = float(value)
+########### Field checks ####################
+# Each check is built once per form field (see services/forms.py) and called as
+# check(value) -> (True, clean value) or (False, error message). Expense labels contain {i},
+# filled in with the line number only when the field fails.
+
+def text_field(label, max_length=MAX_TEXT_FIELD_LENGTH, required=True):
+    missing = f"{label} is required"
+    too_long = f"{label} exceeds maximum length of {max_length} characters"
+    raw_limit = max_length * RAW_LENGTH_FACTOR
+
+    def check(value):
+        if value is None or not str(value).strip():
+            return (False, missing) if required else (True, "")
+        if len(str(value)) > raw_limit:
+            return False, too_long
+        sanitized = sanitize_html(value)
+        if len(sanitized) > max_length:
+            return False, too_long
+        return True, sanitized
+    return check
+
+def email_field(message):
+    def check(value):
+        email = value.strip() if isinstance(value, str) else ''
+        if not validate_email(email):
+            return False, message
+        return True, email
+    return check
+
+def decimal_field(label):
+    def check(value):
+        if not value:
+            return False, f"{label} is required"
+        try:
+            decimal_val = float(value)
+        except (ValueError, TypeError):
+            return False, f"{label} must be a valid number"
+        if not math.isfinite(decimal_val):
+            return False, f"{label} must be a valid number"
         if decimal_val < 0:
-            return False, f"{field_name} cannot be negative"
+            return False, f"{label} cannot be negative"
         if decimal_val > 1000000:  # Sanity check: no single expense over $1M
-            return False, f"{field_name} exceeds maximum allowed value"
-        return True, decimal_val
-    except (ValueError, TypeError):
-        return False, f"{field_name} must be a valid number"
+            return False, f"{label} exceeds maximum allowed value"
+        return True, decimal_val  # Stored as number to prevent addition of backtick
+    return check
+
+def choice_field(options, message):
+    options = frozenset(options)
+
+    def check(value):
+        if value not in options:
+            return False, message
+        return True, value
+    return check
+
+def validate_decimal(value, field_name="amount"):
+    """Validate that a value is a valid decimal number"""
+    return decimal_field(field_name)(value)
 
 def validate_text_field(text, field_name, max_length=MAX_TEXT_FIELD_LENGTH, required=True):
     """Validate and sanitize text fields"""
-    if not text or not text.strip():
-        if required:
-            return False, f"{field_name} is required"
-        return True, ""
-    
-    sanitized = sanitize_html(text)
-    
-    if len(sanitized) > max_length:
-        return False, f"{field_name} exceeds maximum length of {max_length} characters"
-    
-    return True, sanitized
+    return text_field(field_name, max_length, required)(text)
 
 def get_file_extension(filename):
     """Safely extract file extension"""
@@ -159,85 +208,46 @@ def validate_total_file_size(files):
     
     return True, ""
 
-def validate_form_data(endpoint, data):
+def compile_schema(fields, expense_fields):
     """
-    Validate and sanitize all form data
-    Returns: (success: bool, error_message: str, sanitized_data: dict)
+    Build the validator for one form: validate(data) -> (errors, sanitized_data),
+    checking every field and expense line rather than stopping at the first error
     """
-    sanitized = {}
-    
-    # Validate and sanitize firstName
-    valid, result = validate_text_field(data.get('firstName'), 'First name', MAX_NAME_LENGTH)
-    if not valid:
-        return False, result, None
-    sanitized['firstName'] = result
-    
-    # Validate and sanitize lastName
-    valid, result = validate_text_field(data.get('lastName'), 'Last name', MAX_NAME_LENGTH)
-    if not valid:
-        return False, result, None
-    sanitized['lastName'] = result
-    
-    # Validate email
-    email = data.get('email', '').strip()
-    if not validate_email(email):
-        return False, 'Invalid email address', None
-    sanitized['email'] = email
-    
-    # Validate and sanitize comments (optional field)
-    valid, result = validate_text_field(data.get('comments', ''), 'Comments', MAX_COMMENTS_LENGTH, required=False)
-    if not valid:
-        return False, result, None
-    sanitized['comments'] = result
-    
-    # Validate expenses
-    expenses = data.get('expenses', [])
-    if not expenses or not isinstance(expenses, list):
-        return False, 'At least one expense is required', None
-    
-    sanitized_expenses = []
-    for i, expense in enumerate(expenses, 1):
-        sanitized_expense = {}
-        
-        # Validate vendor
-        valid, result = validate_text_field(expense.get('vendor'), f'Vendor (expense {i})', MAX_TEXT_FIELD_LENGTH)
-        if not valid:
-            return False, result, None
-        sanitized_expense['vendor'] = result
-        
-        # Validate description
-        valid, result = validate_text_field(expense.get('description'), f'Description (expense {i})', MAX_TEXT_FIELD_LENGTH)
-        if not valid:
-            return False, result, None
-        sanitized_expense['description'] = result
-        
-        # Validate amount
-        valid, result = validate_decimal(expense.get('amount'), f'Amount (expense {i})')
-        if not valid:
-            return False, result, None
-        sanitized_expense['amount'] = result  # Store as number to prevent addition of backtick
-        
-        # Endpoint-specific fields
-        if endpoint == "Reimbursement Request":
-            # Validate approval field
-            valid, result = validate_text_field(expense.get('approval'), f'Approval/Project (expense {i})', MAX_TEXT_FIELD_LENGTH)
-            if not valid:
-                return False, result, None
-            sanitized_expense['approval'] = result
-            
-            # Validate HST
-            hst_value = expense.get('hst', '')
-            valid_hst_options = [
-                'HST included in amount',
-                'HST excluded from amount',
-                'HST not charged'
-            ]
-            if hst_value not in valid_hst_options:
-                return False, f'Invalid HST value (expense {i})', None
-            sanitized_expense['hst'] = hst_value
-        
-        sanitized_expenses.append(sanitized_expense)
-    
-    sanitized['expenses'] = sanitized_expenses
-    
-    return True, "", sanitized
\ No newline at end of file
+    def validate(data):
+        errors = []
+        sanitized = {}
+        for key, check in fields:
+            ok, result = check(data.get(key))
+            if ok:
+                sanitized[key] = result
+            else:
+                errors.append(result)
+
+        expenses = data.get('expenses')
+        if not expenses or not isinstance(expenses, list):
+            errors.append('At least one expense is required')
+            return errors, sanitized
+
+        sanitized_expenses = []
+        for i, expense in enumerate(expenses, 1):
+            if not isinstance(expense, dict):
+                errors.append(f'Invalid expense {i}')
+                continue
+            sanitized_expense = {}
+            for key, check in expense_fields:
+                ok, result = check(expense.get(key))
+                if ok:
+                    sanitized_expense[key] = result
+                else:
+                    errors.append(result.format(i=i))
+            sanitized_expenses.append(sanitized_expense)
+        sanitized['expenses'] = sanitized_expenses
+        return errors, sanitized
+    return validate
+
+def format_errors(errors):
+    """All errors in one message, capped at MAX_REPORTED_ERRORS"""
+    message = '; '.join(errors[:MAX_REPORTED_ERRORS])
+    if len(errors) > MAX_REPORTED_ERRORS:
+        message += f' (and {len(errors) - MAX_REPORTED_ERRORS} more)'
+    return message